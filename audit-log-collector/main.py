@@ -3,11 +3,35 @@ import os
 import json
 import boto3
 import pathlib
+import argparse
+import sys
+import sqlite3
+import gzip
+import tempfile
+import time
+import random
+import signal
+import threading
+import queue
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import BotoCoreError, ClientError
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# ax_client and ax_metrics are shared with the other tools at the repo root; copies next to this script take precedence
+sys.path.append(str(pathlib.Path(__file__).resolve().parent.parent))
+import ax_client
+import ax_metrics
+from ax_client import retry_delay
+
 # This script is designed to be run from a Cron Job
 
 # Load environment variables from .env file
@@ -22,11 +46,36 @@ s3_bucket = os.getenv("AWS_S3_BUCKET")
 aws_region = os.getenv("AWS_REGION")
 
 url = f"https://console.automox.com/api/audit-service/v1/orgs/{org_uuid}/events"
+checkpoint_file = pathlib.Path(__file__).parent / "checkpoint.db"
+# Only read to migrate the cursor of older versions into the checkpoint store
 cursor_file = pathlib.Path(__file__).parent / "cursor.txt"
-current_date = datetime.now().strftime("%Y-%m-%d")
+LIVE_STREAM = "live"
+# The stdout sink writes events here; progress messages move to stderr when it is enabled
+event_stdout = sys.stdout
+METRICS = ax_metrics.Metrics("audit-log-collector")
+
+
+def current_date():
+    # Evaluated per run rather than at import so a long-lived process doesn't keep querying yesterday
+    return datetime.now().strftime("%Y-%m-%d")
+
+
+def create_client(api_key, pool_size=4, rate=ax_client.DEFAULT_RATE, max_retries=5, conditional=False):
+    """Build a rate-limited, retrying API client whose keep-alive connections are reused by every page of a run.
+
+    With `conditional`, the last few responses are revalidated with If-None-Match, which saves
+    re-downloading the same empty page while a daemon polls a quiet feed.
+    """
+    return ax_client.AutomoxClient(api_key=api_key, rate=rate, max_retries=max_retries, pool_size=pool_size, timeout=30,
+                                   conditional=conditional, etag_cache_size=4, metrics=METRICS)
+
 
+class AuditLogError(Exception):
+    """The Audit Trail API request failed, as opposed to returning no new logs."""
 
-def fetch_audit_logs(url, api_key, date, cursor=None, limit=None):
+
+def fetch_audit_logs(url, api_key, date, cursor=None, limit=None, client=None):
+    """Fetch one page of logs. Returns (None, None) when there are no new logs and raises AuditLogError on failure."""
     print("Fetching logs from the Automox Audit Trail API...")
 
     query = {
@@ -35,65 +84,895 @@ def fetch_audit_logs(url, api_key, date, cursor=None, limit=None):
         "limit": limit
     }
 
-    headers = {
-        "Authorization": f"Bearer {api_key}"
-    }
+    # 429, 5xx and connection errors are retried by the client
+    owns_client = client is None
+    if owns_client:
+        client = create_client(api_key)
+    try:
+        response = client.get(url, params=query)
+    except (requests.ConnectionError, requests.Timeout) as error:
+        print(f"Error: {error}")
+        raise AuditLogError(str(error)) from error
+    finally:
+        if owns_client:
+            client.close()
 
-    response = requests.get(url, headers=headers, params=query)
-    
     # Check for errors
     if response.status_code != 200:
         print(f"Error: {response.status_code} + {response.text}")
-        return None, None
+        raise AuditLogError(f"HTTP {response.status_code}")
 
     data = response.json()
 
     # Check if there are any new logs since last pull
     if data['metadata']['count'] == 0:
-        print("No new logs were found since last pull...Exiting.")
+        print("No new logs were found since last pull.")
         return None, None
 
     # Set the cursor to the last log id
     new_cursor = data['data'][-1]['id']
 
     return data, new_cursor
-    
 
-def send_to_s3(data):
-    s3 = boto3.client('s3')
+
+def drain_audit_logs(url, api_key, date, cursor=None, limit=None, client=None):
+    """Follow the cursor page after page until the API reports no more events.
+
+    Yields (data, new_cursor) one page at a time so callers can ship and
+    checkpoint each page before the next one is requested.
+    """
+    owns_client = client is None
+    if owns_client:
+        client = create_client(api_key)
+    try:
+        while True:
+            data, new_cursor = fetch_audit_logs(url, api_key, date, cursor=cursor, limit=limit, client=client)
+            if not data:
+                return
+            yield data, new_cursor
+            cursor = new_cursor
+    finally:
+        if owns_client:
+            client.close()
+
+
+def json_object_key(data):
+    # Suffix with the last event id so several pages drained in the same second don't overwrite each other
+    return f"automox-audit-logs-{datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}-{data['data'][-1]['id']}.json"
+
+
+def send_to_s3(data, s3=None, key=None):
+    if s3 is None:
+        s3 = boto3.client('s3')
+    if key is None:
+        key = json_object_key(data)
     try:
         print("Uploading logs to S3...")
-        s3.put_object(Bucket=s3_bucket, Key=f"automox-audit-logs-{datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}.json", Body=json.dumps(data))
+        s3.put_object(Bucket=s3_bucket, Key=key, Body=json.dumps(data))
         print("Upload complete!")
+        return True
     except (BotoCoreError, ClientError) as error:
         print(f"Failed to upload logs to S3: {error}")
+        return False
 
 
-def save_last_cursor(cursor):
-    try:
-        with open(cursor_file, 'w+') as file:
-            file.write(cursor)
-    except Exception as error:
-        print(f"Failed to save cursor: {error}")
+class Sink:
+    """Base class for a destination that events are delivered to.
+
+    The pipeline calls `add` with each page of events and a sequence number,
+    `flush` when `should_flush` says buffered events are due, and `close` on
+    shutdown. After each call `committed_seq` holds the sequence number of the
+    last page the sink has durably delivered; the cursor is only checkpointed
+    once every sink has committed a page.
+
+    Each sink de-duplicates against its own namespace of delivered event ids in
+    the CheckpointStore, so a page that one sink already delivered before a
+    crash is not repeated when it is fetched again for a slower sink.
+    """
+
+    name = None
+
+    def __init__(self, store=None):
+        self.store = store
+        self.committed_seq = None
+
+    def filter_new(self, events):
+        if self.store is None:
+            return events
+        return self.store.filter_new(events, self.name)
+
+    def mark_delivered(self, events):
+        if self.store is not None:
+            self.store.mark_delivered(self.name, [event["id"] for event in events if "id" in event])
+
+    def add(self, events, seq):
+        raise NotImplementedError
+
+    def should_flush(self):
+        return False
+
+    def flush(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class S3JSONSink(Sink):
+    """Uploads each page as its own JSON object, the collector's original output format."""
+
+    name = "s3"
+
+    def __init__(self, s3, bucket, store=None):
+        super().__init__(store)
+        self.s3 = s3
+        self.bucket = bucket
+
+    def add(self, events, seq, date=None, cursor=None):
+        events = self.filter_new(events)
+        if not events:
+            self.committed_seq = seq
+            return True
+
+        data = {"metadata": {"count": len(events)}, "data": events}
+        key = json_object_key(data)
+        if self.store is not None:
+            self.store.begin_upload(key, self.name, date, cursor, [event['id'] for event in events])
+        if not send_to_s3(data, s3=self.s3, key=key):
+            if self.store is not None:
+                self.store.abort_upload(key)
+            return False
+        if self.store is not None:
+            self.store.commit_upload(key)
+        self.committed_seq = seq
+        return True
+
+
+class NDJSONBatchSink(Sink):
+    """Buffers events as compressed NDJSON and uploads them to S3 in batches.
+
+    Events are compressed as they are added into a spooled temp file, so memory
+    stays bounded by `spool_size` no matter how big a batch gets. A batch is
+    flushed once `max_bytes` of uncompressed NDJSON are buffered or the oldest
+    buffered event is `max_age` seconds old. Large batches are sent with S3
+    multipart upload. Objects are keyed by UTC date and hour:
+
+        <prefix>/dt=YYYY-MM-DD/hour=HH/automox-audit-logs-<timestamp>-<last id>.ndjson.gz
+
+    When a CheckpointStore is given, each object key is journaled before its
+    upload and the batch's event ids are recorded as delivered once the upload
+    succeeds.
+    """
+
+    name = "s3"
+    EXTENSIONS = {"gzip": ".gz", "zstd": ".zst", "none": ""}
+
+    def __init__(self, s3, bucket, prefix="automox-audit-logs", compression="gzip",
+                 max_bytes=64 * 1024 * 1024, max_age=300, spool_size=8 * 1024 * 1024,
+                 multipart_chunksize=16 * 1024 * 1024, store=None):
+        if compression not in self.EXTENSIONS:
+            raise ValueError(f"Unsupported compression: {compression}")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression requires the 'zstandard' package (pip install zstandard)")
+
+        super().__init__(store)
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.spool_size = spool_size
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_chunksize,
+                                              multipart_chunksize=multipart_chunksize)
+        self._reset()
+
+    def _reset(self):
+        self._buffer = None
+        self._writer = None
+        self._raw_bytes = 0
+        self._event_count = 0
+        self._opened_at = None
+        self._last_id = None
+        self._seq = None
+        self._date = None
+        self._cursor = None
+        self._event_ids = []
+        self._event_id_set = set()
+
+    def _open(self):
+        self._buffer = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        self._open_writer()
+        self._opened_at = time.monotonic()
+
+    def _open_writer(self):
+        # gzip members and zstd frames may be concatenated, so a batch whose stream
+        # was finished by a failed flush can keep growing in a new member/frame
+        if self.compression == "gzip":
+            self._writer = gzip.GzipFile(fileobj=self._buffer, mode="wb")
+        elif self.compression == "zstd":
+            self._writer = zstandard.ZstdCompressor().stream_writer(self._buffer, closefd=False)
+        else:
+            self._writer = self._buffer
+
+    def _object_key(self):
+        now = datetime.now(timezone.utc)
+        return (f"{self.prefix}/dt={now.strftime('%Y-%m-%d')}/hour={now.strftime('%H')}/"
+                f"automox-audit-logs-{now.strftime('%Y-%m-%d-%H-%M-%S')}-{self._last_id}"
+                f".ndjson{self.EXTENSIONS[self.compression]}")
+
+    @property
+    def pending(self):
+        return self._event_count
+
+    def should_flush(self):
+        if not self._event_count:
+            return False
+        if self._raw_bytes >= self.max_bytes:
+            return True
+        return self.max_age is not None and time.monotonic() - self._opened_at >= self.max_age
+
+    def add(self, events, seq, date=None, cursor=None):
+        """Buffer a page of events and flush if a threshold was crossed.
+
+        Returns False if a triggered flush failed to upload. Adding the same
+        page again after a failure is safe, its events are already buffered.
+        """
+        events = self.filter_new([event for event in events if event.get("id") not in self._event_id_set])
+        if not events:
+            if self._event_count:
+                self._seq, self._date, self._cursor = seq, date, cursor
+                # A page added again after a failed flush retries the upload
+                if self.should_flush():
+                    return self.flush()
+            else:
+                self.committed_seq = seq
+            return True
+        if self._buffer is None:
+            self._open()
+        elif self._writer is None:
+            self._open_writer()
+        for event in events:
+            line = json.dumps(event, separators=(",", ":")).encode("utf-8") + b"\n"
+            self._writer.write(line)
+            self._raw_bytes += len(line)
+        self._event_count += len(events)
+        self._last_id = events[-1].get("id", self._last_id)
+        self._seq, self._date, self._cursor = seq, date, cursor
+        for event in events:
+            if "id" in event:
+                self._event_ids.append(event["id"])
+                self._event_id_set.add(event["id"])
+
+        if self.should_flush():
+            return self.flush()
+        return True
+
+    def flush(self):
+        """Upload the buffered batch. Returns False and keeps the batch if the upload fails."""
+        if not self._event_count:
+            return True
+
+        if self._writer is not None and self._writer is not self._buffer:
+            # Finish the compressed stream without closing the underlying spool file
+            self._writer.close()
+        self._writer = None
+        self._buffer.seek(0)
+
+        key = self._object_key()
+        if self.store is not None:
+            self.store.begin_upload(key, self.name, self._date, self._cursor, self._event_ids)
+        try:
+            print(f"Uploading {self._event_count} logs to s3://{self.bucket}/{key}...")
+            self.s3.upload_fileobj(self._buffer, self.bucket, key, Config=self.transfer_config)
+            print("Upload complete!")
+        except (BotoCoreError, ClientError) as error:
+            print(f"Failed to upload logs to S3: {error}")
+            if self.store is not None:
+                self.store.abort_upload(key)
+            self._buffer.seek(0, os.SEEK_END)
+            return False
+
+        if self.store is not None:
+            self.store.commit_upload(key)
+        self.committed_seq = self._seq
+        self._buffer.close()
+        self._reset()
+        return True
+
+    def close(self):
+        if self._buffer is not None:
+            self._buffer.close()
+        self._reset()
+
+
+class LocalFileSink(Sink):
+    """Appends events to rotating NDJSON files in a local directory.
+
+    Every page is fsynced before it counts as delivered. A new file is started
+    once the current one reaches `max_bytes` or is `max_age` seconds old.
+    """
+
+    name = "file"
+
+    def __init__(self, directory, label=LIVE_STREAM, max_bytes=256 * 1024 * 1024, max_age=3600, store=None):
+        super().__init__(store)
+        self.directory = pathlib.Path(directory)
+        self.label = label.replace(":", "-")
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._file = None
+        self._size = 0
+        self._opened_at = None
+
+    def _open(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime('%Y-%m-%d-%H-%M-%S')
+        suffix = 0
+        while True:
+            name = f"automox-audit-logs-{self.label}-{stamp}{f'-{suffix}' if suffix else ''}.ndjson"
+            try:
+                # Exclusive create so a restart within the same second never appends to another file
+                self._file = open(self.directory / name, 'xb')
+                break
+            except FileExistsError:
+                suffix += 1
+        self._size = 0
+        self._opened_at = time.monotonic()
+        print(f"Writing logs to {self.directory / name}")
+
+    def _rotate_due(self):
+        return self._size >= self.max_bytes or (self.max_age is not None and time.monotonic() - self._opened_at >= self.max_age)
+
+    def add(self, events, seq, date=None, cursor=None):
+        events = self.filter_new(events)
+        if events:
+            if self._file is not None and self._rotate_due():
+                self.close()
+            if self._file is None:
+                self._open()
+            try:
+                for event in events:
+                    line = json.dumps(event, separators=(",", ":")).encode("utf-8") + b"\n"
+                    self._file.write(line)
+                    self._size += len(line)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except OSError as error:
+                print(f"Failed to write logs to {self._file.name}: {error}")
+                return False
+            self.mark_delivered(events)
+        self.committed_seq = seq
+        return True
 
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
 
-def read_last_cursor():
+
+class StdoutSink(Sink):
+    """Writes events to stdout as NDJSON for piping into a log shipper."""
+
+    name = "stdout"
+    # Backfill runs one sink per day concurrently; keep their lines from interleaving
+    _write_lock = threading.Lock()
+
+    def __init__(self, stream=None, store=None):
+        super().__init__(store)
+        self.stream = stream if stream is not None else sys.stdout
+
+    def add(self, events, seq, date=None, cursor=None):
+        events = self.filter_new(events)
+        if events:
+            try:
+                with self._write_lock:
+                    for event in events:
+                        self.stream.write(json.dumps(event, separators=(",", ":")) + "\n")
+                    self.stream.flush()
+            except (OSError, ValueError) as error:
+                print(f"Failed to write logs to stdout: {error}")
+                return False
+            self.mark_delivered(events)
+        self.committed_seq = seq
+        return True
+
+
+class CheckpointStore:
+    """Durable collector state in a SQLite database running in WAL mode.
+
+    Tracks, per stream (the live feed or one backfill day), the date and cursor
+    that every sink has delivered, a journal of uploaded object keys, and a
+    bounded per-sink index of recently delivered event ids used to drop
+    duplicates.
+
+    An upload is journaled as pending before it starts and its event ids are
+    recorded as delivered in the same transaction that marks it committed. If
+    the process dies in between, `recover` checks S3 for each pending key on
+    the next start and either commits it or discards it.
+    """
+
+    def __init__(self, path=checkpoint_file, dedupe_window=100000):
+        self.dedupe_window = dedupe_window
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS cursors (
+                stream TEXT PRIMARY KEY,
+                date TEXT,
+                cursor TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS uploads (
+                key TEXT PRIMARY KEY,
+                sink TEXT NOT NULL,
+                date TEXT,
+                cursor TEXT,
+                event_ids TEXT NOT NULL,
+                status TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS seen_events (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                sink TEXT NOT NULL,
+                event_id TEXT NOT NULL,
+                UNIQUE (sink, event_id)
+            );
+        """)
+
+    def _now(self):
+        return datetime.now(timezone.utc).isoformat()
+
+    def get_cursor(self, stream=LIVE_STREAM):
+        with self._lock:
+            row = self._conn.execute("SELECT cursor FROM cursors WHERE stream = ?", (stream,)).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, stream, date, cursor):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO cursors (stream, date, cursor, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(stream) DO UPDATE SET date = excluded.date, cursor = excluded.cursor, updated_at = excluded.updated_at",
+                (stream, date, str(cursor), self._now()),
+            )
+
+    def filter_new(self, events, sink):
+        """Return the events whose ids have not been delivered to the sink yet."""
+        ids = [str(event["id"]) for event in events if "id" in event]
+        seen = set()
+        with self._lock:
+            # Stay well under SQLite's bound parameter limit
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                seen.update(row[0] for row in self._conn.execute(
+                    f"SELECT event_id FROM seen_events WHERE sink = ? AND event_id IN ({placeholders})", [sink] + chunk))
+        if not seen:
+            return events
+        print(f"Skipping {len(seen)} event(s) already delivered to {sink}.")
+        return [event for event in events if str(event.get("id")) not in seen]
+
+    def _mark_delivered(self, sink, event_ids):
+        self._conn.executemany("INSERT OR IGNORE INTO seen_events (sink, event_id) VALUES (?, ?)",
+                               ((sink, str(event_id)) for event_id in event_ids))
+        self._conn.execute(
+            "DELETE FROM seen_events WHERE sink = ? AND seq <= "
+            "(SELECT seq FROM seen_events WHERE sink = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+            (sink, sink, self.dedupe_window))
+
+    def mark_delivered(self, sink, event_ids):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._mark_delivered(sink, event_ids)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def begin_upload(self, key, sink, date, cursor, event_ids):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO uploads (key, sink, date, cursor, event_ids, status, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, 'pending', ?)",
+                (key, sink, date, None if cursor is None else str(cursor),
+                 json.dumps([str(event_id) for event_id in event_ids]), self._now()),
+            )
+
+    def abort_upload(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM uploads WHERE key = ? AND status = 'pending'", (key,))
+
+    def commit_upload(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT sink, event_ids FROM uploads WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return
+            sink, event_ids = row
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._mark_delivered(sink, json.loads(event_ids))
+                # The event ids now live in seen_events; keep only the key in the journal
+                self._conn.execute("UPDATE uploads SET status = 'committed', event_ids = '[]', updated_at = ? WHERE key = ?",
+                                   (self._now(), key))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def pending_uploads(self):
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT key FROM uploads WHERE status = 'pending'")]
+
+    def recover(self, s3, bucket):
+        """Resolve uploads left pending by a crash by checking whether the object reached S3."""
+        for key in self.pending_uploads():
+            try:
+                s3.head_object(Bucket=bucket, Key=key)
+            except ClientError as error:
+                if error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                    print(f"Discarding interrupted upload {key}, its events will be fetched again.")
+                    self.abort_upload(key)
+                    continue
+                raise
+            print(f"Recovered interrupted upload {key}.")
+            self.commit_upload(key)
+
+    def import_legacy_cursor(self, path=cursor_file):
+        """Seed the live stream from a cursor.txt written by older versions of this script."""
+        if self.get_cursor(LIVE_STREAM) is not None:
+            return
+        try:
+            with open(path, 'r') as file:
+                cursor = file.read().strip()
+        except FileNotFoundError:
+            return
+        if cursor:
+            print(f"Importing cursor from {path}.")
+            self.set_cursor(LIVE_STREAM, None, cursor)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class Pipeline:
+    """Fans pages out from the fetcher to one or more sinks running in their own threads.
+
+    Each sink has a bounded queue, so fetching the next page overlaps with
+    delivering the previous one while a slow sink blocks the fetcher instead of
+    letting memory grow. A sink that fails to deliver retries the same page
+    with backoff, up to `max_failures` attempts (None retries until stopped).
+    The stream's cursor is checkpointed once every sink has committed a page.
+    """
+
+    def __init__(self, sinks, store, stream=LIVE_STREAM, queue_size=8, max_failures=3, stop=None):
+        self.sinks = sinks
+        self.store = store
+        self.stream = stream
+        self.max_failures = max_failures
+        self.stop = stop if stop is not None else threading.Event()
+        self.failed = threading.Event()
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in sinks]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._pages = {}
+        self._committed_seq = 0
+
+    def start(self):
+        for sink, sink_queue in zip(self.sinks, self._queues):
+            thread = threading.Thread(target=self._consume, args=(sink, sink_queue), name=f"sink-{sink.name}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def submit(self, data, cursor, date):
+        """Queue a page for every sink. Returns False once the pipeline has failed or been stopped."""
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            self._pages[seq] = (date, cursor)
+        for sink_queue in self._queues:
+            while True:
+                if self.failed.is_set() or self.stop.is_set():
+                    return False
+                try:
+                    sink_queue.put((seq, data['data'], date, cursor), timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+        return not self.failed.is_set()
+
+    def _attempt(self, sink, operation):
+        failures = 0
+        while not operation():
+            failures += 1
+            if self.max_failures is not None and failures >= self.max_failures:
+                print(f"Giving up on the {sink.name} sink after {failures} failed attempt(s).")
+                self.failed.set()
+                return False
+            delay = retry_delay(failures)
+            print(f"Retrying the {sink.name} sink in {delay:.1f}s...")
+            if self.stop.wait(delay):
+                return False
+        self._acknowledge()
+        return True
+
+    def _consume(self, sink, sink_queue):
+        while True:
+            try:
+                item = sink_queue.get(timeout=1)
+            except queue.Empty:
+                # Let age-based batches flush while the feed is quiet
+                if sink.should_flush() and not self._attempt(sink, sink.flush):
+                    return
+                continue
+            if item is None:
+                self._attempt(sink, sink.flush)
+                return
+            if self.failed.is_set():
+                return
+            seq, events, date, cursor = item
+            if not self._attempt(sink, lambda: sink.add(events, seq, date=date, cursor=cursor)):
+                return
+
+    def _acknowledge(self):
+        committed = [sink.committed_seq or 0 for sink in self.sinks]
+        with self._lock:
+            seq = min(committed)
+            if seq <= self._committed_seq:
+                return
+            date, cursor = self._pages[seq]
+            for done in [key for key in self._pages if key <= seq]:
+                del self._pages[done]
+            self._committed_seq = seq
+            self.store.set_cursor(self.stream, date, cursor)
+
+    @property
+    def delivered_pages(self):
+        return self._committed_seq
+
+    def close(self):
+        """Flush every sink and wait for them to finish. Returns False if any sink failed."""
+        for sink_queue, thread in zip(self._queues, self._threads):
+            while thread.is_alive():
+                try:
+                    sink_queue.put(None, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+        for thread in self._threads:
+            thread.join()
+        for sink in self.sinks:
+            sink.close()
+        return not self.failed.is_set()
+
+
+def make_sinks(args, s3, store, label=LIVE_STREAM):
+    sinks = []
+    for name in dict.fromkeys(args.sinks or ["s3"]):
+        if name == "s3" and args.format == "ndjson":
+            sinks.append(NDJSONBatchSink(s3, s3_bucket, prefix=args.prefix, compression=args.compression,
+                                         max_bytes=args.batch_mb * 1024 * 1024, max_age=args.batch_age,
+                                         store=store))
+        elif name == "s3":
+            sinks.append(S3JSONSink(s3, s3_bucket, store=store))
+        elif name == "file":
+            sinks.append(LocalFileSink(args.output_dir, label=label, max_bytes=args.file_rotate_mb * 1024 * 1024,
+                                       max_age=args.file_rotate_age, store=store))
+        elif name == "stdout":
+            sinks.append(StdoutSink(stream=event_stdout, store=store))
+    return sinks
+
+
+def collect(date, args, s3, store, stream=LIVE_STREAM, client=None):
+    """Fetch logs for one date starting from the stream's saved cursor and deliver them to every sink.
+
+    Returns the number of pages delivered, or None if fetching or a sink failed.
+    """
+    last_cursor = store.get_cursor(stream)
+
+    if args.drain:
+        pages = drain_audit_logs(url, api_key, date, cursor=last_cursor, limit=args.limit, client=client)
+    else:
+        try:
+            data, new_cursor = fetch_audit_logs(url, api_key, date, cursor=last_cursor, limit=args.limit, client=client)
+        except AuditLogError:
+            return None
+        pages = [(data, new_cursor)] if data else []
+
+    fetch_failed = False
+    pipeline = Pipeline(make_sinks(args, s3, store, label=stream), store, stream=stream, queue_size=args.queue_size).start()
     try:
-        with open(cursor_file, 'r') as file:
-            return file.read().strip()
-    except FileNotFoundError:
-        print("Cursor file not found.")
+        for data, new_cursor in pages:
+            if not pipeline.submit(data, new_cursor, date):
+                # The cursor stays at the last page every sink delivered, so the next run retries from there
+                break
+    except AuditLogError:
+        # Pages fetched before the error are still delivered and checkpointed
+        fetch_failed = True
+    if not pipeline.close() or fetch_failed:
         return None
+    return pipeline.delivered_pages
+
+
+def backfill(start, end, args, s3, store, client):
+    """Collect every day from start to end (inclusive) with a bounded pool of worker threads.
+
+    Each day drains from its own checkpoint stream, so an interrupted backfill
+    picks up where each day left off when rerun. All days share one client so
+    the rate limit applies to the backfill as a whole.
+    """
+    days = []
+    day = start
+    while day <= end:
+        days.append(day.strftime("%Y-%m-%d"))
+        day += timedelta(days=1)
+
+    def run_day(date):
+        return collect(date, args, s3, store, stream=f"backfill:{date}", client=client)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(run_day, date): date for date in days}
+        for future in as_completed(futures):
+            date = futures[future]
+            try:
+                pages = future.result()
+            except Exception as error:
+                pages = None
+                print(f"Backfill for {date} failed: {error}")
+            if pages is None:
+                failed.append(date)
+            else:
+                print(f"Backfill for {date} complete: {pages} page(s).")
+
+    print(f"Backfilled {len(days) - len(failed)} of {len(days)} day(s).")
+    if failed:
+        print(f"Rerun to resume failed day(s): {', '.join(sorted(failed))}")
+    return not failed
+
+
+def run_daemon(args, s3, store, client):
+    """Poll continuously with a warm API client and S3 client until SIGTERM/SIGINT.
+
+    The poll interval drops to --min-interval while pages come back full and
+    doubles up to --max-interval while the feed is empty. Sinks retry failed
+    deliveries until they succeed, holding back the fetcher meanwhile. On
+    shutdown every sink is flushed and the cursor saved.
+    """
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        print(f"Received signal {signum}, shutting down after the current page...")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    # The pipeline gets its own stop event so sinks can still flush after a shutdown is requested
+    pipeline = Pipeline(make_sinks(args, s3, store), store, queue_size=args.queue_size, max_failures=None).start()
+    cursor = store.get_cursor()
+    active_date = current_date()
+    interval = args.min_interval
+
+    while not stop.is_set():
+        today = current_date()
+        # On rollover, finish the previous day before moving on so events near midnight aren't lost
+        dates = [active_date, today] if today != active_date else [today]
+        pages = 0
+        full = False
+        for date in dates:
+            try:
+                for data, new_cursor in drain_audit_logs(url, api_key, date, cursor=cursor, limit=args.limit, client=client):
+                    pipeline.submit(data, new_cursor, date)
+                    cursor = new_cursor
+                    pages += 1
+                    full = full or (args.limit is not None and len(data['data']) >= args.limit)
+                    if stop.is_set():
+                        break
+            except AuditLogError:
+                # Stay on this date and back off; the next poll resumes from the same cursor
+                break
+            if stop.is_set():
+                break
+        else:
+            active_date = today
+
+        if args.metrics_file:
+            METRICS.write(args.metrics_file, args.metrics_format)
+
+        if full or pages > 1:
+            interval = args.min_interval
+        elif pages == 0:
+            interval = min(interval * 2, args.max_interval)
+        stop.wait(interval * random.uniform(0.9, 1.1))
+
+    # Sinks retry forever while the daemon runs; give the final flush a bounded number of attempts
+    pipeline.max_failures = 3
+    pipeline.close()
+    print("Daemon stopped.")
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid date '{value}', expected YYYY-MM-DD")
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Automox Audit Log Collector")
+    parser.add_argument("--drain", action="store_true", help="Keep following the cursor until no new logs are returned")
+    parser.add_argument("--limit", type=int, default=None, help="Maximum number of events per page")
+    parser.add_argument("--format", choices=["json", "ndjson"], default="json",
+                        help="'json' uploads one object per page, 'ndjson' batches events into compressed NDJSON objects")
+    parser.add_argument("--compression", choices=["gzip", "zstd", "none"], default="gzip", help="Compression for ndjson batches")
+    parser.add_argument("--batch-mb", type=int, default=64, help="Flush an ndjson batch once this many MB of events are buffered")
+    parser.add_argument("--batch-age", type=int, default=300, help="Flush an ndjson batch once its oldest event is this many seconds old")
+    parser.add_argument("--prefix", default="automox-audit-logs", help="S3 key prefix for ndjson batches")
+    parser.add_argument("--daemon", action="store_true", help="Keep running and poll for new logs instead of exiting after one run")
+    parser.add_argument("--min-interval", type=float, default=10, help="Daemon poll interval in seconds while logs are flowing")
+    parser.add_argument("--max-interval", type=float, default=300, help="Longest daemon poll interval in seconds while the feed is empty")
+    parser.add_argument("--sink", dest="sinks", action="append", choices=["s3", "file", "stdout"],
+                        help="Where to deliver logs, may be given more than once (default: s3)")
+    parser.add_argument("--output-dir", default=str(pathlib.Path(__file__).parent / "logs"), help="Directory for the file sink")
+    parser.add_argument("--file-rotate-mb", type=int, default=256, help="Start a new local file once the current one reaches this many MB")
+    parser.add_argument("--file-rotate-age", type=int, default=3600, help="Start a new local file once the current one is this many seconds old")
+    parser.add_argument("--queue-size", type=int, default=8, help="Pages buffered per sink before fetching waits for it to catch up")
+    parser.add_argument("--dedupe-window", type=int, default=100000, help="Number of recently delivered event ids remembered for de-duplication")
+    ax_client.add_arguments(parser, rate_help="Maximum requests per second against the Audit Trail API")
+    ax_metrics.add_arguments(parser)
+    subparsers = parser.add_subparsers(dest="command")
+
+    # Backfill sub-command
+    parser_backfill = subparsers.add_parser("backfill", help="Collect logs for a range of past dates")
+    parser_backfill.add_argument("--from", dest="start", type=parse_date, required=True, help="First date to collect (YYYY-MM-DD)")
+    parser_backfill.add_argument("--to", dest="end", type=parse_date, required=True, help="Last date to collect (YYYY-MM-DD)")
+    parser_backfill.add_argument("--workers", type=int, default=4, help="Number of days to fetch concurrently")
+    args = parser.parse_args()
+
+    if args.sinks and "stdout" in args.sinks:
+        # Keep stdout clean for the events themselves
+        sys.stdout = sys.stderr
+
     print(f"Script start: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    last_cursor = read_last_cursor()
-    data, new_cursor = fetch_audit_logs(url, api_key, current_date, cursor=last_cursor)
-    
-    if data:
-        send_to_s3(data)
-        save_last_cursor(new_cursor)
+    s3 = boto3.client('s3')
+    store = CheckpointStore(dedupe_window=args.dedupe_window)
+    client = create_client(api_key, pool_size=max(4, getattr(args, "workers", 4)), rate=args.rate,
+                           max_retries=args.retries, conditional=args.daemon)
+    try:
+        store.import_legacy_cursor()
+        store.recover(s3, s3_bucket)
+
+        if args.command == "backfill":
+            if args.start > args.end:
+                parser.error("--from must not be after --to")
+            # Every day of a backfill is drained to the end
+            args.drain = True
+            if not backfill(args.start, args.end, args, s3, store, client):
+                sys.exit(1)
+            return
+
+        if args.daemon:
+            run_daemon(args, s3, store, client)
+            return
+
+        pages = collect(current_date(), args, s3, store, client=client)
+        if pages is None:
+            sys.exit(1)
+        if args.drain:
+            print(f"Drained {pages} page(s) of logs.")
+    finally:
+        client.close()
+        store.close()
+        for line in METRICS.format_summary():
+            print(line)
+        if args.metrics_file:
+            METRICS.write(args.metrics_file, args.metrics_format)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
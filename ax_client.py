@@ -0,0 +1,264 @@
+"""Resilient client for the Automox API shared by the automox-tools scripts.
+
+An AutomoxClient wraps one API key (and optionally one org) with:
+
+- a pooled keep-alive requests.Session
+- a token bucket limiting requests per second across every thread using the client, paused for all of them when
+  the API answers 429
+- retries of 429/5xx responses and connection errors with full-jitter backoff that honours Retry-After, capped per
+  request and by a retry budget so an outage doesn't turn into a retry storm. A POST or PATCH may already have been
+  applied when it times out or gets a 5xx, so those are only retried on 429 or when the connection was never made
+- optional conditional GETs: responses carrying an ETag are kept and revalidated with If-None-Match, so an
+  unchanged resource comes back as a body-less 304
+
+The same limiter and retry policy can be applied to an automox_console_sdk ApiClient with wrap_sdk().
+
+Scripts in subdirectories look for this module next to themselves first, then at the repo root.
+"""
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+AX = "https://console.automox.com/api"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+# Conservative default; raise it if the API key isn't shared with other integrations
+DEFAULT_RATE = 10
+ETAG_CACHE_SIZE = 256
+
+
+def retry_delay(attempt, response=None, base=1.0, cap=60.0):
+    """Seconds to wait before retry number `attempt`, honouring Retry-After when the API sends it."""
+    headers = getattr(response, "headers", None) or {}
+    retry_after = headers.get("Retry-After")
+    if retry_after:
+        try:
+            return float(retry_after) + random.uniform(0, 1)
+        except ValueError:
+            pass
+    # Full jitter so concurrent workers don't retry in lockstep
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def never_sent(error):
+    """True when a requests connection error happened before the request reached the server."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` requests per second with bursts of up to `burst`. A rate of 0 disables it."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.resume_at = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.resume_at:
+                    wait = self.resume_at - now
+                elif not self.rate:
+                    return
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Hold back every caller for `seconds`, e.g. after the API said we're over quota."""
+        with self.lock:
+            self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated = self.resume_at
+
+
+class RetryBudget:
+    """Allows retries of up to `ratio` of the requests made, plus a reserve of `reserve` for quiet periods.
+
+    Every request deposits `ratio` of a token and every retry spends a whole one, so a failing API sees at most
+    (1 + ratio) times the normal load instead of max_retries times.
+    """
+
+    def __init__(self, ratio=0.2, reserve=10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = float(reserve)
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.reserve, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class AutomoxClient:
+    """Pooled session, rate limiter and retry policy for one API key.
+
+    With `org_id`, every request gets the `o` query parameter most Automox endpoints expect.
+    """
+
+    def __init__(self, api_key=None, org_id=None, headers=None, base_url=AX, rate=DEFAULT_RATE, burst=None,
+                 max_retries=5, retry_budget=None, pool_size=10, timeout=60, conditional=False,
+                 etag_cache_size=ETAG_CACHE_SIZE, metrics=None):
+        self.org_id = org_id
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.conditional = conditional
+        self.etag_cache_size = etag_cache_size
+        self.metrics = metrics
+        self.limiter = RateLimiter(rate, burst)
+        self.budget = retry_budget if retry_budget is not None else RetryBudget()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Accept": "application/json"})
+        if api_key:
+            self.session.headers["Authorization"] = f"Bearer {api_key}"
+        self.session.headers.update(headers or {})
+        self._etags = OrderedDict()
+        self._etag_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def url(self, path):
+        return path if path.startswith(("https://", "http://")) else f"{self.base_url}{path}"
+
+    def request(self, method, path, params=None, idempotent=None, **kwargs):
+        """Send a request, retrying 429/5xx and connection errors. Returns the last response received.
+
+        Requests that aren't `idempotent`, by default anything but GET, HEAD, OPTIONS, PUT and DELETE, are only
+        retried on 429 or when the connection couldn't be made, so they are never applied twice.
+        """
+        url = self.url(path)
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        retry_statuses = RETRY_STATUSES if idempotent else {429}
+        params = {k: v for k, v in (params or {}).items() if v is not None}
+        if self.org_id is not None:
+            params.setdefault("o", self.org_id)
+        kwargs.setdefault("timeout", self.timeout)
+
+        cache_key = None
+        if self.conditional and method.upper() == "GET" and not kwargs.get("stream"):
+            cache_key = (url, tuple(sorted((k, str(v)) for k, v in params.items())))
+            with self._etag_lock:
+                cached = self._etags.get(cache_key)
+            if cached:
+                kwargs["headers"] = dict(kwargs.get("headers") or {}, **{"If-None-Match": cached[0]})
+
+        self.budget.deposit()
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            try:
+                response = self.session.request(method, url, params=params, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                self._record("record_error", method, url)
+                if not (idempotent or never_sent(error)) or attempt == self.max_retries or not self.budget.withdraw():
+                    raise
+                self._record("record_retry", method, url)
+                time.sleep(retry_delay(attempt))
+                continue
+            if self.metrics:
+                self.metrics.record_response(response)
+            if response.status_code not in retry_statuses or attempt == self.max_retries or not self.budget.withdraw():
+                break
+            delay = retry_delay(attempt, response)
+            if response.status_code == 429:
+                self.limiter.pause(delay)
+            self._record("record_retry", method, url)
+            time.sleep(delay)
+
+        if cache_key is not None:
+            return self._revalidate(cache_key, response)
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def _revalidate(self, cache_key, response):
+        with self._etag_lock:
+            if response.status_code == 304 and cache_key in self._etags:
+                self._etags.move_to_end(cache_key)
+                return self._etags[cache_key][1]
+            etag = response.headers.get("ETag")
+            if response.status_code == 200 and etag:
+                self._etags[cache_key] = (etag, response)
+                self._etags.move_to_end(cache_key)
+                while len(self._etags) > self.etag_cache_size:
+                    self._etags.popitem(last=False)
+        return response
+
+    def _record(self, event, method, url):
+        if self.metrics:
+            getattr(self.metrics, event)(method, url)
+
+    def wrap_sdk(self, api_client):
+        """Apply this client's rate limit, retry policy and budget to every call an automox_console_sdk ApiClient makes."""
+        rest_client = getattr(api_client, "rest_client", None)
+        if rest_client is None:
+            return api_client
+        send = rest_client.request
+
+        def request(method, url, *args, **kwargs):
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+            self.budget.deposit()
+            for attempt in range(self.max_retries + 1):
+                self.limiter.acquire()
+                try:
+                    return send(method, url, *args, **kwargs)
+                except Exception as error:
+                    # The SDK raises ApiException for HTTP errors, with status 0 when no response arrived
+                    status = getattr(error, "status", None)
+                    if status not in RETRY_STATUSES and status != 0:
+                        raise
+                    # A non-idempotent call may have been applied unless the API refused it with 429
+                    if not idempotent and status != 429:
+                        raise
+                    if attempt == self.max_retries or not self.budget.withdraw():
+                        raise
+                    delay = retry_delay(attempt, error)
+                    if status == 429:
+                        self.limiter.pause(delay)
+                    self._record("record_retry", method, url)
+                    time.sleep(delay)
+
+        rest_client.request = request
+        return api_client
+
+    def close(self):
+        self.session.close()
+
+
+def add_arguments(parser, rate_help="Maximum requests per second against the Automox API"):
+    """Adds the --rate and --retries options every tool shares."""
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE, help=f"{rate_help}, 0 for no limit")
+    parser.add_argument("--retries", type=int, default=5, help="Retries for 429, 5xx and connection errors")
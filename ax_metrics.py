@@ -0,0 +1,266 @@
+"""Per-endpoint API metrics shared by the automox-tools scripts.
+
+Each tool keeps one Metrics instance for the run and records every response it gets from the Automox API: latency,
+status code, retries and payload sizes, grouped by method and endpoint. At the end of a run the tool prints a summary
+and can write the same numbers to a file:
+
+    prometheus   text format for node_exporter's textfile collector (written atomically)
+    openmetrics  OpenMetrics exposition, e.g. for pushing to a gateway
+    json         the summary as JSON, for comparing runs
+
+Scripts in subdirectories look for this module next to themselves first, then at the repo root.
+"""
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+FORMATS = ("prometheus", "openmetrics", "json")
+_ID_SEGMENT = re.compile(r"^(\d+|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})$", re.IGNORECASE)
+
+
+def endpoint_name(url):
+    """Path of `url` with numeric and UUID segments collapsed, so /policies/1 and /policies/2 share one series."""
+    path = urlparse(url).path or "/"
+    return "/".join("{id}" if _ID_SEGMENT.match(segment) else segment for segment in path.split("/"))
+
+
+def _payload_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    if isinstance(body, str):
+        return len(body.encode("utf-8"))
+    try:
+        return len(json.dumps(body, default=str).encode("utf-8"))
+    except (TypeError, ValueError):
+        return 0
+
+
+class EndpointStats:
+    """Counters and a latency histogram for one method and endpoint."""
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.statuses = {}
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def observe(self, status, seconds, bytes_sent, bytes_received):
+        self.calls += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        if seconds is not None:
+            self.seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    self.buckets[i] += 1
+                    break
+
+    def quantile(self, q):
+        """Upper bound of the histogram bucket holding quantile `q`, or the slowest call past the last bucket."""
+        timed = self.calls - self.statuses.get("error", 0)
+        if not timed:
+            return None
+        rank = q * timed
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max_seconds)
+        return self.max_seconds
+
+
+class Metrics:
+    """Thread-safe registry of per-endpoint stats for one run of a tool.
+
+    `labels`, e.g. {"org": "1234"}, are added to every exported series so runs of the same tool can be told apart.
+    """
+
+    def __init__(self, tool, labels=None):
+        self.tool = tool
+        self.labels = dict(labels or {})
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def _stats(self, method, url):
+        key = (method.upper(), endpoint_name(url))
+        if key not in self.endpoints:
+            self.endpoints[key] = EndpointStats()
+        return self.endpoints[key]
+
+    def observe(self, method, url, status, seconds=None, bytes_sent=0, bytes_received=0):
+        with self.lock:
+            self._stats(method, url).observe(str(status), seconds, bytes_sent, bytes_received)
+
+    def record_response(self, response):
+        """Record a `requests` response; latency is the time until its headers arrived."""
+        request = response.request
+        if not getattr(response, "_content_consumed", True):
+            # Streamed bodies aren't read here, fall back to the advertised length
+            received = int(response.headers.get("Content-Length") or 0)
+        else:
+            received = len(response.content or b"")
+        self.observe(request.method, request.url, response.status_code, response.elapsed.total_seconds(),
+                     _payload_size(request.body), received)
+
+    def record_error(self, method, url):
+        """Record a request that failed without a response, e.g. a timeout or refused connection."""
+        self.observe(method, url, "error")
+
+    def record_retry(self, method, url):
+        with self.lock:
+            self._stats(method, url).retries += 1
+
+    def instrument_sdk(self, api_client):
+        """Record every call an automox_console_sdk ApiClient makes by wrapping its REST client."""
+        rest_client = getattr(api_client, "rest_client", None)
+        if rest_client is None:
+            return api_client
+        send = rest_client.request
+
+        def request(method, url, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                response = send(method, url, *args, **kwargs)
+            except Exception as error:
+                status = getattr(error, "status", None)
+                self.observe(method, url, status or "error", time.perf_counter() - started if status else None,
+                             _payload_size(kwargs.get("body")), len(getattr(error, "body", None) or b""))
+                raise
+            self.observe(method, url, getattr(response, "status", "unknown"), time.perf_counter() - started,
+                         _payload_size(kwargs.get("body")), len(getattr(response, "data", None) or b""))
+            return response
+
+        rest_client.request = request
+        return api_client
+
+    def summary(self):
+        """The run's metrics as a dict, endpoints sorted by total time spent."""
+        with self.lock:
+            items = sorted(self.endpoints.items(), key=lambda item: item[1].seconds, reverse=True)
+            endpoints = [{
+                "method": method,
+                "endpoint": endpoint,
+                "calls": stats.calls,
+                "statuses": dict(sorted(stats.statuses.items())),
+                "retries": stats.retries,
+                "seconds_total": round(stats.seconds, 6),
+                "seconds_p50": stats.quantile(0.5),
+                "seconds_p95": stats.quantile(0.95),
+                "seconds_max": round(stats.max_seconds, 6),
+                "bytes_sent": stats.bytes_sent,
+                "bytes_received": stats.bytes_received,
+            } for (method, endpoint), stats in items]
+        return {
+            "tool": self.tool,
+            "labels": self.labels,
+            "started": self.started,
+            "duration_seconds": round(time.time() - self.started, 3),
+            "calls": sum(e["calls"] for e in endpoints),
+            "retries": sum(e["retries"] for e in endpoints),
+            "bytes_sent": sum(e["bytes_sent"] for e in endpoints),
+            "bytes_received": sum(e["bytes_received"] for e in endpoints),
+            "endpoints": endpoints,
+        }
+
+    def format_summary(self):
+        """The run summary as printable lines."""
+        summary = self.summary()
+        lines = [f"API calls: {summary['calls']} ({summary['retries']} retried), "
+                 f"{summary['bytes_sent']} bytes sent, {summary['bytes_received']} bytes received "
+                 f"in {summary['duration_seconds']:.1f}s"]
+        if summary["endpoints"]:
+            lines.append(f"{'Endpoint':<50} {'Calls':>6} {'Retries':>7} {'Total s':>8} {'p95 s':>6} {'Max s':>6}  Statuses")
+            for e in summary["endpoints"]:
+                p95 = "-" if e["seconds_p95"] is None else f"{e['seconds_p95']:.2f}"
+                statuses = " ".join(f"{status}:{count}" for status, count in e["statuses"].items())
+                lines.append(f"{e['method'] + ' ' + e['endpoint']:<50} {e['calls']:>6} {e['retries']:>7} "
+                             f"{e['seconds_total']:>8.2f} {p95:>6} {e['seconds_max']:>6.2f}  {statuses}")
+        return lines
+
+    def render(self, openmetrics=False):
+        """Prometheus text exposition of the run, or OpenMetrics when `openmetrics` is set."""
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            # OpenMetrics names counter families without the _total suffix their samples carry
+            family_name = name[:-len("_total")] if openmetrics and kind == "counter" else name
+            lines.append(f"# HELP {family_name} {help_text}")
+            lines.append(f"# TYPE {family_name} {kind}")
+            for sample_name, labels, value in samples:
+                label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                lines.append(f"{sample_name}{{{label_text}}} {value}")
+
+        tool = dict({"tool": self.tool}, **self.labels)
+        with self.lock:
+            items = sorted(self.endpoints.items())
+            duration, responses, retries, sent, received = [], [], [], [], []
+            for (method, endpoint), stats in items:
+                labels = dict(tool, method=method, endpoint=endpoint)
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                    cumulative += count
+                    duration.append(("automox_api_request_duration_seconds_bucket", dict(labels, le=repr(float(bound))), cumulative))
+                timed = stats.calls - stats.statuses.get("error", 0)
+                duration.append(("automox_api_request_duration_seconds_bucket", dict(labels, le="+Inf"), timed))
+                duration.append(("automox_api_request_duration_seconds_count", labels, timed))
+                duration.append(("automox_api_request_duration_seconds_sum", labels, round(stats.seconds, 6)))
+                for status, count in sorted(stats.statuses.items()):
+                    responses.append(("automox_api_responses_total", dict(labels, status=status), count))
+                retries.append(("automox_api_retries_total", labels, stats.retries))
+                sent.append(("automox_api_request_bytes_total", labels, stats.bytes_sent))
+                received.append(("automox_api_response_bytes_total", labels, stats.bytes_received))
+
+        family("automox_api_request_duration_seconds", "histogram", "Latency of Automox API requests.", duration)
+        family("automox_api_responses_total", "counter", "Automox API responses by status code, 'error' when none arrived.", responses)
+        family("automox_api_retries_total", "counter", "Automox API requests that were retried.", retries)
+        family("automox_api_request_bytes_total", "counter", "Bytes sent in Automox API request bodies.", sent)
+        family("automox_api_response_bytes_total", "counter", "Bytes received in Automox API response bodies.", received)
+        family("automox_run_start_time_seconds", "gauge", "Unix time the run started.",
+               [("automox_run_start_time_seconds", tool, round(self.started, 3))])
+        family("automox_run_duration_seconds", "gauge", "Seconds the run has taken so far.",
+               [("automox_run_duration_seconds", tool, round(time.time() - self.started, 3))])
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, fmt="prometheus"):
+        """Atomically write the metrics to `path` so a collector never reads a half-written file."""
+        if fmt == "json":
+            content = json.dumps(self.summary(), indent=2) + "\n"
+        else:
+            content = self.render(openmetrics=fmt == "openmetrics")
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metrics-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as metrics_file:
+                metrics_file.write(content)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def add_arguments(parser):
+    """Adds the --metrics-file and --metrics-format options every tool shares."""
+    parser.add_argument("--metrics-file", help="Also write this run's API metrics to this file")
+    parser.add_argument("--metrics-format", choices=FORMATS, default="prometheus",
+                        help="Format of --metrics-file: Prometheus textfile, OpenMetrics or a JSON summary")
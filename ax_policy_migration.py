@@ -1,7 +1,14 @@
 #!/usr/bin/env python3
 
-from pprint import pprint
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import ax_client
+import ax_metrics
+import hashlib
+import json
 import requests
+import threading
+import time
 import os
 
 #===========================================================#
@@ -10,7 +17,8 @@ import os
 
 # Current org environment variables
 AX_API_TOKEN = os.environ.get("AX_API_TOKEN")
-AX = "https://console.automox.com/api"
+AX_ORG_ID = os.environ.get("AX_ORG_ID", "Current Org ID")
+AX = ax_client.AX
 AX_HEADERS = {
     "Accept": "application/json",
     "Content-Type": "application/json",
@@ -19,6 +27,7 @@ AX_HEADERS = {
 
 # New org environment variables
 AX_API_TOKEN_2 = os.environ.get("AX_API_TOKEN_2")
+AX_ORG_ID_2 = os.environ.get("AX_ORG_ID_2", "New Org ID")
 AX_HEADERS_2 = {
     "Accept": "application/json",
     "Content-Type": "application/json",
@@ -27,57 +36,310 @@ AX_HEADERS_2 = {
 
 #======================================================================================================================#
 # SCRIPT_INFO                                                                                                          #
-# This script was built to migrate policies from one Automox org to another.  It will only move policies that are not  #
-# currently in the new org.  If it detects a policy with the same name it will give a 400 response.  Response code 201 #
-# means it successfully moved a policy                                                                                 #
+# This script was built to migrate policies from one Automox org to another.  The new org's policies are loaded once   #
+# and matched by name: missing policies are created, policies whose content differs are updated and identical ones     #
+# are skipped, so re-running a partial migration only sends the delta.  Use --dry-run to print the plan first.         #
+#                                                                                                                      #
+# Every outcome is appended to a journal mapping source policy IDs to new policy IDs.  With --resume, policies the     #
+# journal shows were already migrated unchanged are skipped.  --target-org may be repeated to copy to several orgs.    #
+#                                                                                                                      #
+# Policies are paged through in full and migrated by a pool of worker threads sharing one keep-alive session per org.  #
+# Each org gets its own ax_client with a request rate limit; 429/5xx responses and connection errors are retried       #
+# with backoff inside a retry budget, so an outage doesn't multiply the load on the API.                               #
+#                                                                                                                      #
+# A summary of API calls, retries, latency and status codes per endpoint is printed at the end of every run;           #
+# --metrics-file also writes it as a Prometheus textfile, OpenMetrics or JSON.                                         #
 #                                                                                                                      #
 # Author: Ryan Braunstein                                                                                              #
 # Company: Automox, Inc.                                                                                               #
-# Version: 1.0                                                                                                         #
-# Version Notes: Be the first to update this section!!!                                                                #
+# Version: 1.5                                                                                                         #
+# Version Notes: Requests go through the shared ax_client module                                                       #
 #======================================================================================================================#
 
-# Retrieves all policy ID numbers from the current org
-def retrieve_all_policy_ids():
-    policy_ids = []
-    query = {
-    "o": "Current Org ID",
-    "page": "0",
-    "limit": "500"
-    }
-    #Cycles through the policy IDs and adds them to a list
-    ax_policies = requests.get(f"{AX}/policies", headers=AX_HEADERS, params=query)
-    data = ax_policies.json()
-    for policy in data:
-        policy_ids.append(policy['id'])
-
-    return policy_ids
-
-# Runs through the list of policies, formats them, and POSTs them to the new Org
-def list_specific_policy(policy_ids):
-    query = {
-        "o": "Current Org ID"
-    }
-    for id in policy_ids:
-        ax_policies = requests.get(f"{AX}/policies/{id}", headers=AX_HEADERS, params=query)
+PAGE_LIMIT = 500
+METRICS = ax_metrics.Metrics("ax_policy_migration")
+
+
+# Retrieves every policy in an org, one page at a time
+def retrieve_all_policies(client):
+    policies = []
+    page = 0
+    while True:
+        ax_policies = client.request("GET", "/policies", params={"page": page, "limit": PAGE_LIMIT})
+        ax_policies.raise_for_status()
         data = ax_policies.json()
-        query2 = {
-        "o": "New Org ID"
-        }
-        # Formats all relevant info for the current org to be POSTed to the new org
-        body = {
+        policies.extend(data)
+        if len(data) < PAGE_LIMIT:
+            break
+        page += 1
+
+    return policies
+
+
+# Formats all relevant info for the current org to be POSTed to the new org
+def format_policy(data, org_id):
+    return {
         "name": data['name'],
         "policy_type_name": data['policy_type_name'],
-        "organization_id": 'New Org ID',
+        "organization_id": org_id,
         "schedule_days": data['schedule_days'],
         "schedule_weeks_of_month": data['schedule_weeks_of_month'],
         "schedule_months": data['schedule_months'],
         "schedule_time": data['schedule_time'],
         "configuration": data['configuration']
+    }
+
+
+# Fields the API sets itself, never sent back when updating a policy
+READ_ONLY_FIELDS = ('id', 'uuid', 'organization_id', 'create_time', 'server_count')
+
+
+# Hashes the migrated fields of a policy so the same policy in two orgs compares equal
+def policy_hash(data):
+    body = format_policy(data, None)
+    del body['organization_id']
+    canonical = json.dumps(body, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+# Loads the new org's policies once and indexes them by name, keeping the fields migration doesn't manage
+# (server groups, notes) so that an update, which replaces the whole policy, sends them back unchanged
+def index_policies(target):
+    index = {}
+    for policy in retrieve_all_policies(target):
+        if policy['name'] in index:
+            print(f"Warning: the new org has more than one policy named '{policy['name']}', comparing against the first")
+            continue
+        migrated = format_policy(policy, None)
+        unmanaged = {key: value for key, value in policy.items() if key not in READ_ONLY_FIELDS and key not in migrated}
+        index[policy['name']] = {"id": policy['id'], "hash": policy_hash(policy), "unmanaged": unmanaged}
+    return index
+
+
+# Append-only record of what has been migrated to which org, used by --resume
+class MigrationJournal:
+    DONE = {"created", "updated", "unchanged"}
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r') as journal_file:
+                for line in journal_file:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A crash can leave a partial last line behind
+                        continue
+                    self.entries[(str(entry['target_org']), str(entry['source_id']))] = entry
+
+    def completed(self, target_org, policy):
+        """Returns the journal entry if this exact version of the policy already reached the target org."""
+        entry = self.entries.get((str(target_org), str(policy['id'])))
+        if entry and entry['result'] in self.DONE and entry['hash'] == policy_hash(policy):
+            return entry
+        return None
+
+    def record(self, result):
+        entry = {
+            "target_org": result['target_org'],
+            "source_id": result['id'],
+            "target_id": result['target_id'],
+            "name": result['name'],
+            "hash": result['hash'],
+            "result": result['result'],
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
         }
-        ax_policies_post = requests.post(f"{AX}/policies", json=body, headers=AX_HEADERS_2, params=query2)
-        pprint(ax_policies_post)
+        line = json.dumps(entry) + "\n"
+        with self.lock:
+            with open(self.path, 'a') as journal_file:
+                journal_file.write(line)
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            self.entries[(str(entry['target_org']), str(entry['source_id']))] = entry
+
+
+# Decides whether each policy needs to be created, updated or skipped in one target org
+def plan_migration(policies, target, journal=None, resume=False):
+    plan = []
+    pending = []
+    for policy in policies:
+        entry = journal.completed(target.org_id, policy) if resume and journal else None
+        if entry:
+            plan.append({"action": "done", "policy": policy, "target": target, "target_id": entry['target_id']})
+        else:
+            pending.append(policy)
+    if not pending:
+        return plan
+
+    index = index_policies(target)
+    print(f"Found {len(index)} policies in org {target.org_id}")
+    for policy in pending:
+        existing = index.get(policy['name'])
+        if existing is None:
+            action = "create"
+        elif existing['hash'] != policy_hash(policy):
+            action = "update"
+        else:
+            action = "skip"
+        plan.append({"action": action, "policy": policy, "target": target, "target_id": existing['id'] if existing else None,
+                     "unmanaged": existing['unmanaged'] if existing else {}})
+    return plan
+
+
+def print_plan(plan):
+    name_width = max([len("Policy")] + [len(step['policy']['name']) for step in plan])
+    org_width = max([len("Target org")] + [len(str(step['target'].org_id)) for step in plan])
+    print(f"{'Action':<6}  {'Target org':<{org_width}}  {'Policy':<{name_width}}  {'Source ID':>10}  {'Target ID':>10}")
+    print(f"{'-' * 6}  {'-' * org_width}  {'-' * name_width}  {'-' * 10}  {'-' * 10}")
+    for step in sorted(plan, key=lambda step: (step['action'], str(step['target'].org_id), step['policy']['name'].lower())):
+        print(f"{step['action']:<6}  {str(step['target'].org_id):<{org_width}}  {step['policy']['name']:<{name_width}}  "
+              f"{step['policy']['id']:>10}  {str(step['target_id'] or '-'):>10}")
+    counts = {}
+    for step in plan:
+        counts[step['action']] = counts.get(step['action'], 0) + 1
+    print()
+    print(f"Plan: {counts.get('create', 0)} to create, {counts.get('update', 0)} to update, {counts.get('skip', 0)} unchanged, "
+          f"{counts.get('done', 0)} already migrated")
+
+
+# Creates or updates one policy in its target org
+def migrate_policy(step):
+    started = time.monotonic()
+    policy = step['policy']
+    target = step['target']
+    result = {"id": policy['id'], "name": policy['name'], "target_org": target.org_id, "target_id": step['target_id'],
+              "hash": policy_hash(policy), "status": None, "result": "error"}
+    try:
+        body = format_policy(policy, target.org_id)
+        if step['action'] == "create":
+            ax_policies_post = target.request("POST", "/policies", json=body)
+            result["status"] = ax_policies_post.status_code
+            result["result"] = "created" if ax_policies_post.status_code == 201 else "create failed"
+            if ax_policies_post.status_code == 201:
+                try:
+                    result["target_id"] = ax_policies_post.json().get('id')
+                except ValueError:
+                    pass
+        else:
+            # PUT replaces the whole policy, so send back the target's server groups and notes as they are
+            body = dict(step['unmanaged'], **body)
+            body['id'] = step['target_id']
+            ax_policies_put = target.request("PUT", f"/policies/{step['target_id']}", json=body)
+            result["status"] = ax_policies_put.status_code
+            result["result"] = "updated" if ax_policies_put.status_code in (200, 204) else "update failed"
+    except (requests.RequestException, KeyError, ValueError) as error:
+        result["result"] = f"error: {error}"
+    finally:
+        result["seconds"] = time.monotonic() - started
+    return result
+
+
+# Runs through the planned changes with a pool of workers and sends them to the target orgs
+def list_specific_policy(plan, journal=None, workers=8):
+    results = []
+    for step in plan:
+        if step['action'] in ("skip", "done"):
+            result = {"id": step['policy']['id'], "name": step['policy']['name'], "target_org": step['target'].org_id,
+                      "target_id": step['target_id'], "hash": policy_hash(step['policy']), "status": None,
+                      "result": "unchanged" if step['action'] == "skip" else "already migrated", "seconds": 0.0}
+            if journal and step['action'] == "skip":
+                # Only journal a skip that tells the next --resume something new, so reruns don't grow the file
+                entry = journal.completed(result['target_org'], step['policy'])
+                if not entry or str(entry['target_id']) != str(result['target_id']):
+                    journal.record(result)
+            results.append(result)
+    changes = [step for step in plan if step['action'] in ("create", "update")]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(migrate_policy, step) for step in changes]
+        for count, future in enumerate(as_completed(futures), start=1):
+            result = future.result()
+            if journal:
+                journal.record(result)
+            print(f"[{count}/{len(changes)}] {result['target_org']} {result['name']}: {result['result']}")
+            results.append(result)
+    return results
+
+
+def print_summary(results, elapsed):
+    name_width = max([len("Policy")] + [len(str(r['name'] or r['id'])) for r in results])
+    org_width = max([len("Target org")] + [len(str(r['target_org'])) for r in results])
+    print()
+    print(f"{'Target org':<{org_width}}  {'Policy':<{name_width}}  {'ID':>10}  {'New ID':>10}  {'HTTP':>4}  {'Time':>7}  Result")
+    print(f"{'-' * org_width}  {'-' * name_width}  {'-' * 10}  {'-' * 10}  {'-' * 4}  {'-' * 7}  {'-' * 16}")
+    for r in sorted(results, key=lambda r: (str(r['target_org']), str(r['name'] or r['id']).lower())):
+        print(f"{str(r['target_org']):<{org_width}}  {str(r['name'] or r['id']):<{name_width}}  {r['id']:>10}  "
+              f"{str(r['target_id'] or '-'):>10}  {str(r['status'] or '-'):>4}  {r['seconds']:>6.2f}s  {r['result']}")
+    totals = {}
+    for r in results:
+        outcome = r['result'].split(":")[0]
+        totals[outcome] = totals.get(outcome, 0) + 1
+    print()
+    print(f"{len(results)} policies in {elapsed:.1f}s: " + ", ".join(f"{count} {outcome}" for outcome, count in sorted(totals.items())))
+
+
+# Turns ORG_ID or ORG_ID=TOKEN_ENV_VAR into a client for that org
+def parse_target(value, args):
+    org_id, _, token_var = value.partition("=")
+    token = os.environ.get(token_var) if token_var else AX_API_TOKEN_2
+    if token_var and token is None:
+        raise SystemExit(f"Error: environment variable {token_var} for org {org_id} is not set")
+    headers = dict(AX_HEADERS_2, Authorization=f"Bearer {token}")
+    return org_client(org_id, headers, args.target_rate, args)
+
+
+# Rate-limited, retrying client for one org that shares its keep-alive connections between workers
+def org_client(org_id, headers, rate, args):
+    return ax_client.AutomoxClient(org_id=org_id, headers=headers, base_url=AX, rate=rate, max_retries=args.retries,
+                                   pool_size=args.workers, metrics=METRICS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate Automox policies from one org to one or more other orgs")
+    parser.add_argument("--source-org", default=AX_ORG_ID, help="ID of the org to copy policies from (default: $AX_ORG_ID)")
+    parser.add_argument("--target-org", action="append",
+                        help="ID of an org to copy policies to, optionally as ORG_ID=TOKEN_ENV_VAR when it needs its own API key. "
+                             "May be given more than once (default: $AX_ORG_ID_2 with $AX_API_TOKEN_2)")
+    parser.add_argument("--workers", type=int, default=8, help="Number of policies migrated concurrently")
+    parser.add_argument("--source-rate", type=float, default=10, help="Maximum requests per second against the current org")
+    parser.add_argument("--target-rate", type=float, default=10, help="Maximum requests per second against each new org")
+    parser.add_argument("--retries", type=int, default=5, help="Retries for 429 and 5xx responses")
+    parser.add_argument("--dry-run", action="store_true", help="Print the planned creates and updates without changing the new orgs")
+    parser.add_argument("--journal", default="migration_journal.jsonl", help="File recording which policies were migrated to which org")
+    parser.add_argument("--resume", action="store_true", help="Skip policies the journal shows were already migrated unchanged")
+    ax_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    source = org_client(args.source_org, AX_HEADERS, args.source_rate, args)
+    targets = [parse_target(value, args) for value in dict.fromkeys(args.target_org or [AX_ORG_ID_2])]
+    journal = MigrationJournal(args.journal)
+    started = time.monotonic()
+    try:
+        # Source bodies are fetched once and reused for every target org
+        policies = retrieve_all_policies(source)
+        print(f"Found {len(policies)} policies in org {args.source_org}")
+        plan = []
+        for target in targets:
+            plan.extend(plan_migration(policies, target, journal=journal, resume=args.resume))
+        if args.dry_run:
+            print_plan(plan)
+            return
+        results = list_specific_policy(plan, journal=journal, workers=args.workers)
+        print_summary(results, time.monotonic() - started)
+    finally:
+        source.close()
+        for target in targets:
+            target.close()
+        print()
+        for line in METRICS.format_summary():
+            print(line)
+        if args.metrics_file:
+            METRICS.write(args.metrics_file, args.metrics_format)
+
 
 if __name__ == "__main__":
-    policies = retrieve_all_policy_ids()
-    list_specific_policy(policies)
\ No newline at end of file
+    main()
@@ -0,0 +1,315 @@
+"""Offline benchmark for Worklet Warden against a local stand-in for the Automox policies API.
+
+Serves synthetic orgs of different sizes from a local HTTP server and times sync, diff and update end to end,
+each in a fresh process so that peak memory is measured per operation:
+
+    python3 benchmark.py --sizes 10 500 5000 --script-kb 4 --output bench.json
+    python3 benchmark.py --sizes 500 --profile profiles/
+
+Every result records the operation, policy count, script size, wall time, API calls made (by method and path),
+bytes written by the process and its peak RSS, so runs on different commits can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ORG_ID = 1
+
+
+def synthetic_policy(policy_id, script_kb, rng):
+    os_family = ["Windows", "Linux", "Mac"][policy_id % 3]
+    line = "Write-Output '{}'\n" if os_family == "Windows" else "echo '{}'\n"
+    script = "".join(line.format("".join(rng.choices(string.ascii_letters, k=60)))
+                     for _ in range(max(1, script_kb * 1024 // 80)))
+    return {
+        "id": policy_id,
+        "uuid": f"00000000-0000-0000-0000-{policy_id:012d}",
+        "name": f"Benchmark Worklet {policy_id}",
+        "organization_id": ORG_ID,
+        "create_time": "2024-01-01T00:00:00+0000",
+        "server_count": rng.randint(0, 500),
+        "policy_type_name": "custom",
+        "notes": "",
+        "schedule_days": 254,
+        "schedule_weeks_of_month": 62,
+        "schedule_months": 8190,
+        "schedule_time": "02:00",
+        "server_groups": [],
+        "configuration": {
+            "os_family": os_family,
+            "device_filters_enabled": False,
+            "auto_reboot": False,
+            "evaluation_code": script[:len(script) // 4],
+            "remediation_code": script,
+        },
+    }
+
+
+class MockPoliciesAPI:
+    """In-memory policies for one org plus a count of the calls made against them."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.policies = {}
+        self.calls = {}
+        self.bytes_sent = 0
+
+    def load(self, count, script_kb, seed=0):
+        rng = random.Random(seed)
+        with self.lock:
+            self.policies = {i: synthetic_policy(i, script_kb, rng) for i in range(1, count + 1)}
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.calls), self.bytes_sent
+
+    def record(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body=None):
+            payload = b"" if body is None else json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            with api.lock:
+                api.bytes_sent += len(payload)
+
+        def _body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def _route(self):
+            parsed = urlparse(self.path)
+            parts = [p for p in parsed.path.split("/") if p]
+            if parts and parts[-1].isdigit() and len(parts) >= 2 and parts[-2] == "policies":
+                return "/policies/{id}", int(parts[-1]), parse_qs(parsed.query)
+            if parts and parts[-1] == "policies":
+                return "/policies", None, parse_qs(parsed.query)
+            return None, None, None
+
+        def do_GET(self):
+            route, policy_id, query = self._route()
+            api.record(f"GET {route}")
+            if route == "/policies":
+                limit = int(query.get("limit", ["500"])[0])
+                page = int(query.get("page", ["0"])[0])
+                with api.lock:
+                    ordered = [api.policies[k] for k in sorted(api.policies)]
+                self._send(200, ordered[page * limit:(page + 1) * limit])
+            elif route == "/policies/{id}" and policy_id in api.policies:
+                self._send(200, api.policies[policy_id])
+            else:
+                self._send(404, {"errors": ["not found"]})
+
+        def do_PUT(self):
+            route, policy_id, _ = self._route()
+            api.record(f"PUT {route}")
+            body = self._body()
+            if route != "/policies/{id}" or policy_id not in api.policies:
+                return self._send(404, {"errors": ["not found"]})
+            with api.lock:
+                # Like the real API, a PUT replaces the policy and only keeps the fields the server sets itself
+                current = api.policies[policy_id]
+                api.policies[policy_id] = dict(body)
+                api.policies[policy_id].update({key: current[key] for key in ("id", "uuid", "organization_id", "create_time",
+                                                                             "server_count") if key in current})
+            self._send(204)
+
+        def do_POST(self):
+            route, _, _ = self._route()
+            api.record(f"POST {route}")
+            body = self._body()
+            if route != "/policies":
+                return self._send(404, {"errors": ["not found"]})
+            with api.lock:
+                policy_id = max(api.policies, default=0) + 1
+                api.policies[policy_id] = dict(body)
+                api.policies[policy_id].update(id=policy_id, organization_id=ORG_ID)
+                created = api.policies[policy_id]
+            self._send(201, created)
+
+    return Handler
+
+
+def modify_local_policies(fraction):
+    """Edits the remediation script of a fraction of the local policies so update has work to do."""
+    names = sorted(d for d in os.listdir("policies") if os.path.isdir(os.path.join("policies", d)))
+    changed = names[:max(1, int(len(names) * fraction))] if names else []
+    for name in changed:
+        for script in os.listdir(os.path.join("policies", name)):
+            if script.startswith("remediation_code"):
+                with open(os.path.join("policies", name, script), "a") as script_file:
+                    script_file.write("\n# benchmark edit\n")
+    return len(changed)
+
+
+def process_bytes_written():
+    try:
+        with open("/proc/self/io") as io_file:
+            for line in io_file:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def run_worker(args):
+    """Runs one operation in this process and prints its measurements as JSON."""
+    os.environ["AUTOMOX_ORG"] = str(ORG_ID)
+    os.environ["AUTOMOX_API_KEY"] = "benchmark"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    import worklet_warden
+
+    worklet_warden.CONFIG.host = args.base_url
+    worklet_warden.API.limiter = worklet_warden.ax_client.RateLimiter(args.rate)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    operations = {
+        "sync": lambda: worklet_warden.sync_policies(sync_mode="full"),
+        "sync-warm": lambda: worklet_warden.sync_policies(sync_mode="full"),
+        "diff": lambda: worklet_warden.diff_policies(run_mode="normal"),
+        "update": lambda: worklet_warden.update_policies(),
+    }
+
+    written_before = process_bytes_written()
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    started = time.perf_counter()
+    operations[args.op]()
+    wall_seconds = time.perf_counter() - started
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+    written_after = process_bytes_written()
+
+    json.dump({
+        "wall_seconds": wall_seconds,
+        "bytes_written": None if written_before is None else written_after - written_before,
+        "peak_rss_kb": peak_rss_kb(),
+    }, sys.stdout)
+
+
+def run_step(api, base_url, op, workdir, profile_dir, label, rate=0):
+    calls_before, sent_before = api.snapshot()
+    command = [sys.executable, os.path.abspath(__file__), "_worker", "--op", op, "--base-url", base_url, "--rate", str(rate)]
+    if profile_dir:
+        command += ["--profile", os.path.join(profile_dir, f"{label}-{op}.prof")]
+    completed = subprocess.run(command, cwd=workdir, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"{op} failed:\n{completed.stderr}")
+    result = json.loads(completed.stdout)
+    calls_after, sent_after = api.snapshot()
+    result["api_calls"] = {k: calls_after.get(k, 0) - calls_before.get(k, 0)
+                           for k in calls_after if calls_after.get(k, 0) != calls_before.get(k, 0)}
+    result["api_calls_total"] = sum(result["api_calls"].values())
+    result["api_bytes_received"] = sent_after - sent_before
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Worklet Warden against a mock Automox policies API")
+    subparsers = parser.add_subparsers(dest="command")
+    parser_worker = subparsers.add_parser("_worker", help=argparse.SUPPRESS)
+    parser_worker.add_argument("--op", required=True)
+    parser_worker.add_argument("--base-url", required=True)
+    parser_worker.add_argument("--profile")
+    parser_worker.add_argument("--rate", type=float, default=0)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 500, 5000], help="Number of policies in each synthetic org")
+    parser.add_argument("--script-kb", type=int, default=4, help="Approximate size of each remediation script in KB")
+    parser.add_argument("--modify", type=float, default=0.1, help="Fraction of local policies edited before update")
+    parser.add_argument("--output", default="-", help="Where to write the JSON results, '-' for stdout")
+    parser.add_argument("--profile", metavar="DIR", help="Write a cProfile .prof file per operation to this directory")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary working directories")
+    parser.add_argument("--rate", type=float, default=0, help="Client request rate limit, 0 to measure without throttling")
+    args = parser.parse_args()
+
+    if args.command == "_worker":
+        return run_worker(args)
+
+    api = MockPoliciesAPI()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(api))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+
+    results = []
+    try:
+        for size in args.sizes:
+            api.load(size, args.script_kb)
+            workdir = tempfile.mkdtemp(prefix=f"warden-bench-{size}-")
+            label = f"{size}x{args.script_kb}kb"
+            try:
+                for op in ["sync", "sync-warm", "diff", "update"]:
+                    extra = {}
+                    if op == "update":
+                        cwd = os.getcwd()
+                        os.chdir(workdir)
+                        try:
+                            extra["policies_modified"] = modify_local_policies(args.modify)
+                        finally:
+                            os.chdir(cwd)
+                    result = run_step(api, base_url, op, workdir, args.profile, label, rate=args.rate)
+                    result = dict(operation=op, policies=size, script_kb=args.script_kb, **extra, **result)
+                    print(f"{label:>12} {op:<10} {result['wall_seconds']:8.2f}s {result['api_calls_total']:6d} calls "
+                          f"{result['peak_rss_kb'] or 0:8d} KB peak", file=sys.stderr)
+                    results.append(result)
+            finally:
+                if not args.keep:
+                    shutil.rmtree(workdir, ignore_errors=True)
+    finally:
+        server.shutdown()
+
+    report = {
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    report_json = json.dumps(report, indent=2) + "\n"
+    if args.output == "-":
+        sys.stdout.write(report_json)
+    else:
+        with open(args.output, "w") as output_file:
+            output_file.write(report_json)
+
+
+if __name__ == "__main__":
+    main()
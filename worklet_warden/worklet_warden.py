@@ -4,24 +4,46 @@ import logging
 import json
 import argparse
 import difflib
+import hashlib
 import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
+# ax_client and ax_metrics are shared with the other tools at the repo root; copies next to this script take precedence
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+try:
+    import ax_client
+    import ax_metrics
+except ImportError as error:
+    sys.exit(f"Worklet Warden needs ax_client.py and ax_metrics.py from the automox-tools repo, next to this script "
+             f"or on PYTHONPATH, and the requests package: {error}")
 
-# Attempt to retrieve environment variables
+
+# Attempt to retrieve environment variables, checked in main() unless several orgs are given on the command line
 ORG = os.getenv('AUTOMOX_ORG')
 API_KEY = os.getenv('AUTOMOX_API_KEY')
 
-# Check if either environment variable is not set
-if ORG is None or API_KEY is None:
-    print("Error: AUTOMOX_ORG and AUTOMOX_API_KEY environment variables must be set.")
-    sys.exit(1)  # Exit with an error status code
-
 CONFIG = automox.Configuration()
-
-client = automox.ApiClient(configuration=CONFIG)
-client.default_headers['Authorization'] = f"Bearer {API_KEY}"
-policies_api = automox.PoliciesApi(client)
+# Enough keep-alive connections for the update workers and the page prefetcher
+CONFIG.connection_pool_maxsize = 16
+
+def configure_org(org, api_key, rate=ax_client.DEFAULT_RATE, max_retries=5):
+    """Points the module at one org with its own SDK client, rate limiter and metrics."""
+    global ORG, API_KEY, client, METRICS, API, policies_api
+    ORG, API_KEY = org, api_key
+    client = automox.ApiClient(configuration=CONFIG)
+    client.default_headers['Authorization'] = f"Bearer {api_key}"
+    METRICS = ax_metrics.Metrics("worklet_warden", labels={"org": org})
+    METRICS.instrument_sdk(client)
+    # Rate limit and retry policy for every SDK call; wrapped after the metrics so each attempt is recorded
+    API = ax_client.AutomoxClient(api_key=api_key, rate=rate, max_retries=max_retries, metrics=METRICS)
+    API.wrap_sdk(client)
+    policies_api = automox.PoliciesApi(client)
+
+configure_org(ORG, API_KEY)
 keys_to_ignore = ['uuid', 'id', 'organization_id', 'create_time', 'server_count']
+PAGE_SIZE = 500
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -31,15 +53,117 @@ logger = logging.getLogger()
 #### Program Starts Here
 #############################
 
-def delete_dir_contents(path):
-    """Recursively deletes the contents of a directory."""
-    for filename in os.listdir(path):
-        file_path = os.path.join(path, filename)
-        if os.path.isfile(file_path) or os.path.islink(file_path):
-            os.remove(file_path)  # Remove files and links
-        elif os.path.isdir(file_path):
-            delete_dir_contents(file_path)  # Recursively delete directory contents
-            os.rmdir(file_path)  # Remove now-empty directory
+def iter_policies(page_size=PAGE_SIZE, prefetch=True):
+    """Yields every remote policy, one page at a time.
+
+    With prefetch the next page is requested in the background while the current one is processed,
+    so at most two pages are held in memory."""
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        fetch = lambda page: policies_api.get_policies(o=ORG, limit=page_size, page=page)
+        page = 0
+        pending = executor.submit(fetch, page) if prefetch else None
+        while True:
+            policies = pending.result() if prefetch else fetch(page)
+            # A short page is the last one, so there is nothing to prefetch after it
+            if prefetch and len(policies) >= page_size:
+                pending = executor.submit(fetch, page + 1)
+            logger.debug(f"Fetched page {page} with {len(policies)} policies")
+            yield from policies
+            if len(policies) < page_size:
+                return
+            page += 1
+
+# Local caches live here rather than in policies/ or state/, which are committed by the backup workflow
+CACHE_DIR = ".worklet_warden"
+
+def cache_path(name):
+    """Path of a cache file in CACHE_DIR, creating the directory with a .gitignore that ignores all of it."""
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(os.path.join(CACHE_DIR, ".gitignore"), 'w') as gitignore:
+            gitignore.write("*\n")
+    return os.path.join(CACHE_DIR, name)
+
+def manifest_path():
+    return cache_path(f"manifest.{ORG}.json")
+
+def load_manifest():
+    """Load the hash and modification time of each file written by the last sync, keyed by path."""
+    try:
+        with open(manifest_path(), 'r') as manifest_file:
+            return json.load(manifest_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_manifest(manifest):
+    """Save the manifest, sorted so that it only changes on disk when its contents do."""
+    write_if_changed(manifest_path(), json.dumps(manifest, sort_keys=True, indent=2))
+    # Older versions kept the manifest in state/, where the backup workflow committed it
+    legacy_path = os.path.join("state", f".manifest.{ORG}.json")
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+
+def atomic_write(path, content, mode=None):
+    """Write a file via a temporary file and rename so readers never see it half written."""
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(content)
+        os.chmod(tmp_path, mode if mode is not None else 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def write_if_changed(path, content, manifest=None, mode=None):
+    """Write content to path unless the file already holds it. Returns True if the file was written.
+
+    When the manifest has the hash of the file and its size and modification time are unchanged the file is not
+    read at all, otherwise the current contents are compared before rewriting. Checking the modification time
+    means a local edit that kept the file's size is still overwritten.
+    """
+    content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    size = len(content.encode('utf-8'))
+    try:
+        current = os.stat(path)
+    except FileNotFoundError:
+        current = None
+
+    unchanged = False
+    if current is not None and current.st_size == size:
+        entry = manifest.get(path) if manifest is not None else None
+        if isinstance(entry, dict) and entry.get("hash") == content_hash and entry.get("mtime_ns") == current.st_mtime_ns:
+            unchanged = True
+        else:
+            with open(path, 'r') as current_file:
+                unchanged = current_file.read() == content
+
+    if not unchanged:
+        atomic_write(path, content, mode)
+        current = os.stat(path)
+    if manifest is not None:
+        manifest[path] = {"hash": content_hash, "mtime_ns": current.st_mtime_ns}
+    return not unchanged
+
+def prune_deleted_policies(remote_policy_names, manifest):
+    """Remove this org's remote state for policies that no longer exist remotely."""
+    state_dir = "state"
+    removed = []
+    if not os.path.isdir(state_dir):
+        return removed
+    for policy_name in os.listdir(state_dir):
+        folder_name_remote = os.path.join(state_dir, policy_name)
+        if policy_name in remote_policy_names or not os.path.isdir(folder_name_remote):
+            continue
+        remote_json_path = os.path.join(folder_name_remote, f"policy.json.remote.{ORG}")
+        if os.path.exists(remote_json_path):
+            os.remove(remote_json_path)
+            removed.append(policy_name)
+        manifest.pop(remote_json_path, None)
+        if not os.listdir(folder_name_remote):
+            os.rmdir(folder_name_remote)
+    return removed
 
 def normalize_line_endings(s):
     """Normalize the line endings in a string to use Unix-style (\n)."""
@@ -64,10 +188,10 @@ def rehydrate_scripts_for_diff(policy_dict, policy_name):
     policy_name = policy_name.lower().replace(" ", "_")
     folder_name = f"policies/{policy_name}"
     
-    # Make a deep copy of the policy_dict to modify without affecting the original
-    rehydrated_policy_dict = json.loads(json.dumps(policy_dict))
-
-    configuration = rehydrated_policy_dict.get('configuration', {})
+    # Only the configuration is modified, so copying it and the top level leaves the original untouched
+    rehydrated_policy_dict = dict(policy_dict)
+    configuration = dict(policy_dict.get('configuration') or {})
+    rehydrated_policy_dict['configuration'] = configuration
     script_keys = ['remediation_code', 'evaluation_code']
 
     for key in script_keys:
@@ -88,9 +212,9 @@ def rehydrate_scripts_for_diff(policy_dict, policy_name):
 
     return rehydrated_policy_dict
 
-def save_policy_and_scripts(policy_dict, policy_id, policy_name, run_mode):
+def save_policy_and_scripts(policy_dict, policy_id, policy_name, run_mode, manifest=None):
     """Extracts scripts if conditions are met, saves them with the appropriate extension, 
-    and handles saving policy states based on the run_mode."""
+    and handles saving policy states based on the run_mode. Only files whose content changed are written."""
     logger.debug(f"Processing policy {policy_id} - {policy_name} for remote state.")
     policy_name = policy_name.lower().replace(" ", "_")
     folder_name_remote = f"state/{policy_name}"
@@ -102,11 +226,9 @@ def save_policy_and_scripts(policy_dict, policy_id, policy_name, run_mode):
     # Serialize policy_dict to JSON string and encode to bytes
     remote_policy = normalize_line_endings(json.dumps(policy_dict, sort_keys=True, indent=2))
 
-    # Write the bytes with Unix line endings to file in binary mode
-    with open(remote_json_path, 'w') as remote_json_file:
-        remote_json_file.write(remote_policy)
+    written = write_if_changed(remote_json_path, remote_policy, manifest)
 
-    logger.debug(f"Saved remote state for policy {policy_id} - {policy_name}.")
+    logger.debug(f"{'Saved' if written else 'Unchanged'} remote state for policy {policy_id} - {policy_name}.")
 
     # If run_mode is 'full', proceed to process the policy for local state, including script handling
     if run_mode == "full":
@@ -123,177 +245,537 @@ def save_policy_and_scripts(policy_dict, policy_id, policy_name, run_mode):
                 if key in configuration:
                     script_filename = f"{key}{script_extension}"
                     script_path = os.path.join(folder_name, script_filename)
-                    with open(script_path, 'w') as script_file:
-                        script_file.write(configuration[key])
-                    if script_extension == ".sh":
-                        os.chmod(script_path, 0o755)  # Make shell scripts executable
+                    # Make shell scripts executable
+                    mode = 0o755 if script_extension == ".sh" else None
+                    written = write_if_changed(script_path, configuration[key], manifest, mode) or written
                     configuration[key] = script_filename  # Update with placeholder
 
         # Save the modified policy dictionary as JSON (local state)
         policy_dict = remove_keys_from_dict(policy_dict, keys_to_ignore)
         local_policy_json = normalize_line_endings(json.dumps(policy_dict, sort_keys=True, indent=2))
         local_json_path = os.path.join(folder_name, "policy.json")
-        with open(local_json_path, 'w') as local_json_file:
-            local_json_file.write(local_policy_json)
+        written = write_if_changed(local_json_path, local_policy_json, manifest) or written
 
     logger.debug(f"Completed processing for policy {policy_id} - {policy_name} in {run_mode} mode.")
+    return written
 
 
-def sync_policies(sync_mode, debug=False):
+def sync_policies(sync_mode, debug=False, prefetch=True):
     """Pull the policies from the remote Automox API and update them on disk."""
     if debug:
         logger.setLevel(logging.DEBUG)
 
-    state_dir = "state/"
-    if os.path.exists(state_dir):
-        delete_dir_contents(state_dir)  # Delete contents of the state directory
-        os.rmdir(state_dir)  # Remove the now-empty state directory
+    os.makedirs("state", exist_ok=True)
+    manifest = load_manifest()
+    remote_policy_names = set()
+    changed = 0
 
-    # Proceed with syncing policies
-    for policy in policies_api.get_policies(o=ORG, limit=500, page=0):
+    # Proceed with syncing policies, only touching files whose content changed
+    for policy in iter_policies(prefetch=prefetch):
         logger.debug(f"Processing policy {policy['id']}")
-        save_policy_and_scripts(policy, policy['id'], policy['name'], sync_mode)
-
-def diff_policies(debug=False, run_mode='normal'):
-    """Compares local and remote policy states, logs differences, or returns a list of policies that need to be updated or created."""
+        remote_policy_names.add(policy['name'].lower().replace(" ", "_"))
+        if save_policy_and_scripts(policy, policy['id'], policy['name'], sync_mode, manifest):
+            changed += 1
+
+    removed = prune_deleted_policies(remote_policy_names, manifest)
+    for policy_name in removed:
+        logger.info(f"Policy {policy_name} no longer exists remotely, removed its remote state.")
+    save_manifest(manifest)
+    logger.info(f"Synced {len(remote_policy_names)} policies: {changed} changed, {len(removed)} removed.")
+    return {"policies": len(remote_policy_names), "changed": changed, "removed": len(removed)}
+
+def canonical_remote_policy(policy_dict):
+    """Serializes a policy from the API the same way its remote state is written to and read back from disk."""
+    return normalize_line_endings(json.dumps(remove_keys_from_dict(policy_dict, keys_to_ignore), sort_keys=True, indent=2))
+
+LOCAL_INDEX_NAME = "index.json"
+LOCAL_INDEX_VERSION = 2
+
+def load_local_index():
+    """Loads the cache of local policy hashes, discarding it if it was built with different settings."""
+    try:
+        with open(cache_path(LOCAL_INDEX_NAME), 'r') as index_file:
+            index = json.load(index_file)
+    except (FileNotFoundError, ValueError):
+        index = {}
+    if index.get("version") != LOCAL_INDEX_VERSION or index.get("keys_to_ignore") != keys_to_ignore:
+        index = {"version": LOCAL_INDEX_VERSION, "keys_to_ignore": keys_to_ignore, "policies": {}}
+    index["dirty"] = False
+    return index
+
+def save_local_index(index, policy_names=None):
+    """Saves the cache if anything changed, dropping entries for policies that no longer exist locally."""
+    if policy_names is not None:
+        for policy_name in set(index["policies"]) - set(policy_names):
+            del index["policies"][policy_name]
+            index["dirty"] = True
+    if not index.pop("dirty") or not os.path.isdir("policies"):
+        return
+    atomic_write(cache_path(LOCAL_INDEX_NAME), json.dumps(index, sort_keys=True))
+    # Older versions kept the index inside policies/, where the backup workflow committed it
+    legacy_path = os.path.join("policies", ".index.json")
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+
+def policy_files_signature(policy_name):
+    """The name, mtime and size of every file in a policy folder. Any edit to the policy changes it."""
+    folder_name = os.path.join("policies", policy_name)
+    signature = []
+    with os.scandir(folder_name) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                signature.append([entry.name, stat.st_mtime_ns, stat.st_size])
+    return sorted(signature)
+
+def canonical_local_policy(policy_name, index=None):
+    """Serializes a local policy with its scripts rehydrated, ready to compare with the remote one.
+
+    With an index, a policy whose files are unchanged since it was last serialized costs a stat of its folder,
+    and only its hash is returned: the string is None. Call again without the index when the string is needed."""
+    signature = policy_files_signature(policy_name) if index is not None else None
+    if index is not None:
+        cached = index["policies"].get(policy_name)
+        if cached and cached["files"] == signature:
+            return None, cached["hash"]
+
+    with open(os.path.join("policies", policy_name, "policy.json"), 'r') as local_file:
+        local_policy = json.load(local_file)
+    local_policy_rehydrated = rehydrate_scripts_for_diff(local_policy, policy_name)
+    local_policy_str = json.dumps(remove_keys_from_dict(local_policy_rehydrated, keys_to_ignore), sort_keys=True, indent=2)
+    local_policy_hash = content_hash(local_policy_str)
+
+    if index is not None:
+        index["policies"][policy_name] = {"files": signature, "hash": local_policy_hash}
+        index["dirty"] = True
+    return local_policy_str, local_policy_hash
+
+def content_hash(policy_str):
+    return hashlib.sha256(policy_str.encode('utf-8')).hexdigest()
+
+def unified_policy_diff(local_policy_str, remote_policy_str):
+    """Line-by-line diff of two canonical policies. Module level so it can run in a worker process."""
+    return list(difflib.unified_diff(
+        local_policy_str.splitlines(keepends=True),
+        remote_policy_str.splitlines(keepends=True),
+        fromfile="local",
+        tofile="remote",
+    ))
+
+def compare_policies(workers=None, prefetch=True, use_index=True, with_diffs=True):
+    """Compares the live remote policies with the local policies/ tree without writing anything to disk.
+
+    Returns one result per policy with its status ('unchanged', 'modified', 'missing-remote' or 'missing-local'),
+    remote id, the content hashes of both sides and, for modified policies, the canonical strings and unified diff.
+    Policies whose hashes match are never diffed, and without `with_diffs` nothing is: callers that only act on the
+    status skip the costliest step. The diffs are spread over a process pool when there are many.
+    The hashes of local policies are cached in .worklet_warden/index.json and reused while their files are unchanged,
+    so only policies that differ from remote are read from disk."""
+    policies_path = "policies/"
+    index = load_local_index() if use_index else None
+    local_policy_names = set()
+    if os.path.isdir(policies_path):
+        local_policy_names = {d for d in os.listdir(policies_path) if os.path.isdir(os.path.join(policies_path, d))}
+
+    results = {}
+    for policy in iter_policies(prefetch=prefetch):
+        policy_name = policy['name'].lower().replace(" ", "_")
+        remote_policy_str = canonical_remote_policy(policy)
+        result = {"name": policy_name, "id": policy['id'], "remote_hash": content_hash(remote_policy_str), "local_hash": None}
+        results[policy_name] = result
+        if policy_name not in local_policy_names:
+            result["status"] = "missing-local"
+            continue
+        try:
+            local_policy_str, result["local_hash"] = canonical_local_policy(policy_name, index)
+        except FileNotFoundError:
+            logger.error(f"Error accessing policy files for {policy_name}")
+            result["status"] = "error"
+            continue
+        if result["local_hash"] == result["remote_hash"]:
+            result["status"] = "unchanged"
+        else:
+            result["status"] = "modified"
+            if local_policy_str is None:
+                local_policy_str = canonical_local_policy(policy_name)[0]
+            result["local"] = local_policy_str
+            result["remote"] = remote_policy_str
+
+    for policy_name in local_policy_names - set(results):
+        result = {"name": policy_name, "id": None, "status": "missing-remote", "remote_hash": None, "local_hash": None}
+        try:
+            result["local_hash"] = canonical_local_policy(policy_name, index)[1]
+        except FileNotFoundError:
+            logger.error(f"Error accessing policy files for {policy_name}")
+        results[policy_name] = result
+
+    if index is not None:
+        save_local_index(index, local_policy_names)
+
+    modified = [r for r in results.values() if r["status"] == "modified"] if with_diffs else []
+    if workers and workers > 1 and len(modified) >= 32:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            diffs = executor.map(unified_policy_diff, [r["local"] for r in modified], [r["remote"] for r in modified],
+                                 chunksize=max(1, len(modified) // (workers * 4)))
+            for result, diff in zip(modified, diffs):
+                result["diff"] = diff
+    else:
+        for result in modified:
+            result["diff"] = unified_policy_diff(result["local"], result["remote"])
+
+    return sorted(results.values(), key=lambda r: r["name"])
+
+def diff_policies(debug=False, run_mode='normal', workers=None):
+    """Compares local and remote policy states and logs differences; 'flag' mode only logs the policies to create.
+    Returns the names of the policies that need to be updated and created."""
     if debug:
         logger.setLevel(logging.DEBUG)
 
-    # Ensure the local state is synced with the current remote state
-    sync_policies(sync_mode="normal")
-
-    policies_path = "policies/"
-    state_path = "state/"
-    policies_needing_update = []  # Initialize empty list to track policies needing updates
-    policies_missing_remote = []  # Initialize empty list to track For policy creations
-
-    local_policy_names = [d for d in os.listdir(policies_path) if os.path.isdir(os.path.join(policies_path, d))]
-    remote_policy_names = [d for d in os.listdir(state_path) if os.path.isdir(os.path.join(state_path, d))]
-
-    # Identify policies that exist locally but not remotely
-    for policy_name in local_policy_names:
-        if policy_name not in remote_policy_names:
-            policies_missing_remote.append(policy_name)
-            continue  # Skip the diff process for policies missing remotely
+    results = compare_policies(workers=workers, with_diffs=run_mode == 'normal')
+    policies_needing_update = [r["name"] for r in results if r["status"] == "modified"]
+    policies_missing_remote = [r["name"] for r in results if r["status"] == "missing-remote"]
 
-        local_json_path = os.path.join(policies_path, policy_name, "policy.json")
-        remote_json_path = os.path.join(state_path, policy_name, f"policy.json.remote.{ORG}")
+    for result in results:
+        if result["status"] == "modified" and run_mode == 'normal':
+            logger.info(f"Policy {result['name']} differs between local and remote states (ignoring keys: {', '.join(keys_to_ignore)}):")
+            for line in result["diff"]:
+                logger.info(line.rstrip())
+        elif result["status"] == "unchanged":
+            logger.debug(f"Policy {result['name']} (ignoring keys: {', '.join(keys_to_ignore)}) is identical between local and remote states.")
+        elif result["status"] == "missing-local":
+            logger.debug(f"Policy {result['name']} exists in remote but not local states")
 
-        try:
-            with open(local_json_path, 'r') as local_file, open(remote_json_path, 'r') as remote_file:
-                local_policy = json.load(local_file)
-                remote_policy = json.load(remote_file)
-
-            local_policy_rehydrated = rehydrate_scripts_for_diff(local_policy, policy_name)
-            local_policy_rehydrated_cleaned = remove_keys_from_dict(local_policy_rehydrated, keys_to_ignore)
-            remote_policy_cleaned = remove_keys_from_dict(remote_policy, keys_to_ignore)
-
-            local_policy_str = json.dumps(local_policy_rehydrated_cleaned, sort_keys=True, indent=2)
-            remote_policy_str = json.dumps(remote_policy_cleaned, sort_keys=True, indent=2)
-
-            # Generate line-by-line diff
-            diff = list(difflib.unified_diff(
-                local_policy_str.splitlines(keepends=True),
-                remote_policy_str.splitlines(keepends=True),
-                fromfile="local",
-                tofile="remote",
-            ))
-
-            if diff:
-                if run_mode == 'normal':
-                    logger.info(f"Policy {policy_name} differs between local and remote states (ignoring keys: {', '.join(keys_to_ignore)}):")
-                    for line in diff:
-                        logger.info(line.rstrip())
-                elif run_mode == 'flag':
-                    policies_needing_update.append(policy_name)
-            else:
-                logger.debug(f"Policy {policy_name} (ignoring keys: {', '.join(keys_to_ignore)}) is identical between local and remote states.")
-        except FileNotFoundError:
-            logger.error(f"Error accessing policy files for {policy_name}")
-        
     if policies_missing_remote:
         for policy in policies_missing_remote:
             logger.info(f"Policy: {policy} exists in local but not remote states and needs created")
 
-    if run_mode == 'flag':
-        return policies_needing_update, policies_missing_remote
-
-def update_policies(debug=False):
-    """Updates policies by posting them to the Automox API."""
-    policies_to_update = diff_policies(debug=debug, run_mode='flag')
-    
+    return policies_needing_update, policies_missing_remote
+
+def changed_field_paths(local_value, remote_value, path=""):
+    """Lists the dotted paths of the fields that differ between two policy dicts."""
+    if isinstance(local_value, dict) and isinstance(remote_value, dict):
+        paths = []
+        for key in sorted(set(local_value) | set(remote_value)):
+            child_path = f"{path}.{key}" if path else key
+            if key not in local_value or key not in remote_value:
+                paths.append(child_path)
+            elif local_value[key] != remote_value[key]:
+                paths.extend(changed_field_paths(local_value[key], remote_value[key], child_path))
+        return paths
+    return [path] if local_value != remote_value else []
+
+def plan_policies(output="plan.json", debug=False, prefetch=True):
+    """Writes a JSON report of what `update` would change and returns the exit code for CI.
+
+    Exit codes: 0 when local and remote match, 2 when there are policies to update or create, 1 on errors."""
     if debug:
         logger.setLevel(logging.DEBUG)
-    
-    for policy_name in policies_to_update[0]:
-        logger.info(f"Starting update to policy {policy_name} in remote.")
-        try:
-            # Rehydrate the policy into its full form
-            policy_path = f"policies/{policy_name}/policy.json"
-            with open(policy_path, 'r') as policy_file:
-                policy_data = json.load(policy_file)
-
-            policy_state = f"state/{policy_name}/policy.json.remote." + str(ORG)
-            with open(policy_state, 'r') as state_file:
-                state_data = json.load(state_file)
-
-            policy_id = state_data['id']
-            # Rehydrate any scripts 
-            policy_data_full = rehydrate_scripts_for_diff(policy_data, policy_name)
-            policy_data_full['organization_id'] = ORG
+
+    results = compare_policies(prefetch=prefetch, with_diffs=False)
+    policies = []
+    summary = {"unchanged": 0, "modified": 0, "missing-remote": 0, "missing-local": 0, "error": 0}
+    for result in results:
+        summary[result["status"]] += 1
+        entry = {
+            "name": result["name"],
+            "id": result["id"],
+            "status": result["status"],
+            "local_hash": result["local_hash"],
+            "remote_hash": result["remote_hash"],
+            "changed_fields": [],
+        }
+        if result["status"] == "modified":
+            entry["changed_fields"] = changed_field_paths(json.loads(result["local"]), json.loads(result["remote"]))
+        policies.append(entry)
+
+    report = {
+        "org": ORG,
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "ignored_keys": keys_to_ignore,
+        "summary": summary,
+        "policies": policies,
+    }
+    report_json = json.dumps(report, indent=2) + "\n"
+    if output == "-":
+        sys.stdout.write(report_json)
+    else:
+        atomic_write(output, report_json)
+        logger.info(f"Wrote plan to {output}")
+
+    logger.info(f"Plan: {summary['modified']} to update, {summary['missing-remote']} to create, "
+                f"{summary['unchanged']} unchanged, {summary['missing-local']} only in remote, {summary['error']} errors.")
+    if summary["error"]:
+        return 1
+    if summary["modified"] or summary["missing-remote"]:
+        return 2
+    return 0
+
+def load_policy_for_push(policy_name):
+    """Reads a local policy and rehydrates its scripts into the full form the API expects."""
+    policy_path = f"policies/{policy_name}/policy.json"
+    with open(policy_path, 'r') as policy_file:
+        policy_data = json.load(policy_file)
+    policy_data_full = rehydrate_scripts_for_diff(policy_data, policy_name)
+    policy_data_full['organization_id'] = ORG
+    return policy_data_full
+
+def push_policy(policy_name, action, policy_id=None):
+    """Updates or creates a single policy in remote and reports how it went."""
+    started = time.monotonic()
+    result = {"name": policy_name, "action": action, "id": None, "outcome": "failed", "error": None}
+    try:
+        policy_data_full = load_policy_for_push(policy_name)
+        if action == "update":
             policy_data_full['id'] = policy_id
+            result["id"] = policy_id
             policies_api.update_policy(policy_data_full, id=policy_id, o=ORG)
-            sync_policies(sync_mode="normal")
-            
-            logger.info(f"Successfully updated policy {policy_name} in remote.")
-        except Exception as e:
-            logger.error(f"Error updating policy {policy_name}: {e}")
-    for policy_name in policies_to_update[1]:
-        logger.info(f"Starting create on policy {policy_name} in remote.")
-        try:
-            # Rehydrate the policy into its full form
-            policy_path = f"policies/{policy_name}/policy.json"
-            with open(policy_path, 'r') as policy_file:
-                policy_data = json.load(policy_file)
-
-            # Rehydrate any scripts 
-            policy_data_full = rehydrate_scripts_for_diff(policy_data, policy_name)
-            policy_data_full['organization_id'] = ORG
-            policies_api.create_policy(body=policy_data_full, o=ORG)
-            sync_policies(sync_mode="normal")
-            
-            logger.info(f"Successfully Created policy {policy_name} in remote.")
-        except Exception as e:
-            logger.error(f"Error creating policy {policy_name}: {e}")
+            result["outcome"] = "updated"
+        else:
+            # The SDK discards the response body, so read the new policy's id from the raw response
+            response = policies_api.create_policy(body=policy_data_full, o=ORG, _preload_content=False)
+            result["outcome"] = "created"
+            try:
+                created = json.loads(response.data or b"null")
+                result["id"] = created.get('id') if isinstance(created, dict) else None
+            except ValueError:
+                pass
+    except Exception as e:
+        result["error"] = str(e)
+        logger.error(f"Error {'updating' if action == 'update' else 'creating'} policy {policy_name}: {e}")
+    result["seconds"] = time.monotonic() - started
+    return result
+
+def refresh_remote_state(results):
+    """Re-downloads the remote state of just the policies that were pushed."""
+    manifest = load_manifest()
+    pushed_ids = [r["id"] for r in results if r["outcome"] in ("updated", "created") and r["id"] is not None]
+    unknown_names = {r["name"] for r in results if r["outcome"] == "created" and r["id"] is None}
+
+    for policy_id in pushed_ids:
+        policy = policies_api.get_policy(id=policy_id, o=ORG)
+        if hasattr(policy, 'to_dict'):
+            policy = policy.to_dict()
+        save_policy_and_scripts(policy, policy['id'], policy['name'], "normal", manifest)
+
+    if unknown_names:
+        # Only when the create response had no id: look the policies up by name, stopping once all are found
+        for policy in iter_policies():
+            policy_name = policy['name'].lower().replace(" ", "_")
+            if policy_name in unknown_names:
+                save_policy_and_scripts(policy, policy['id'], policy['name'], "normal", manifest)
+                unknown_names.discard(policy_name)
+                if not unknown_names:
+                    break
+
+    save_manifest(manifest)
+
+def update_policies(debug=False, workers=4):
+    """Updates policies by posting them to the Automox API.
+
+    The change set is computed once, then updates and creates are sent concurrently and only the
+    remote state of the touched policies is refreshed afterwards."""
+    if debug:
+        logger.setLevel(logging.DEBUG)
 
+    comparison = compare_policies(with_diffs=False)
+    changes = [(r["name"], "update", r["id"]) for r in comparison if r["status"] == "modified"]
+    changes += [(r["name"], "create", None) for r in comparison if r["status"] == "missing-remote"]
+    if not changes:
+        logger.info("No policies need to be updated or created.")
+        return []
+
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(push_policy, policy_name, action, policy_id): policy_name for policy_name, action, policy_id in changes}
+        for future in as_completed(futures):
+            result = future.result()
+            if result["error"] is None:
+                logger.info(f"Successfully {result['outcome']} policy {result['name']} in remote ({result['seconds']:.2f}s).")
+            results.append(result)
+
+    try:
+        refresh_remote_state(results)
+    except Exception as e:
+        logger.error(f"Error refreshing remote state, run sync to bring state/ up to date: {e}")
+
+    name_width = max(len("Policy"), *(len(r["name"]) for r in results))
+    logger.info(f"{'Policy':<{name_width}}  {'Action':<6}  {'Outcome':<7}  {'Time':>7}")
+    for r in sorted(results, key=lambda r: r["name"]):
+        logger.info(f"{r['name']:<{name_width}}  {r['action']:<6}  {r['outcome']:<7}  {r['seconds']:>6.2f}s")
+    failed = sum(1 for r in results if r["error"] is not None)
+    logger.info(f"Pushed {len(results) - failed} of {len(results)} policies, {failed} failed.")
+    return results
+
+
+def parse_org(value):
+    """Turns ORG or ORG=TOKEN_ENV_VAR into an (org, api_key) pair, using $AUTOMOX_API_KEY when no variable is named."""
+    org, _, token_var = value.partition("=")
+    api_key = os.environ.get(token_var) if token_var else os.getenv('AUTOMOX_API_KEY')
+    if api_key is None:
+        raise SystemExit(f"Error: environment variable {token_var or 'AUTOMOX_API_KEY'} for org {org} is not set.")
+    return org, api_key
+
+def load_org_config(path):
+    """Reads a JSON object mapping org ids to API keys. A key written as "$NAME" is read from that environment variable."""
+    with open(path, 'r') as config_file:
+        config = json.load(config_file)
+    orgs = []
+    for org, api_key in config.items():
+        if isinstance(api_key, str) and api_key.startswith("$"):
+            token_var = api_key[1:]
+            api_key = os.environ.get(token_var)
+            if api_key is None:
+                raise SystemExit(f"Error: environment variable {token_var} for org {org} is not set.")
+        orgs.append((str(org), api_key))
+    return orgs
+
+def org_metrics_path(path, org):
+    """metrics.prom becomes metrics.<org>.prom, so a textfile collector picks up one file per org."""
+    root, extension = os.path.splitext(path)
+    return f"{root}.{org}{extension}"
+
+def run_org(command, org, api_key, directory, options):
+    """Runs sync or diff for one org in a worker process, inside that org's own directory.
+
+    Returns the outcome with the org's API metrics; errors are reported in the outcome rather than raised."""
+    configure_org(org, api_key, rate=options["rate"], max_retries=options["retries"])
+    for handler in logger.handlers:
+        handler.setFormatter(logging.Formatter(f'%(asctime)s - %(levelname)s - [{org}] %(message)s'))
+    os.makedirs(directory, exist_ok=True)
+    os.chdir(directory)
+
+    outcome = {"org": org, "error": None}
+    started = time.monotonic()
+    try:
+        if command == "sync":
+            outcome.update(sync_policies(sync_mode=options["mode"], debug=options["debug"], prefetch=options["prefetch"]))
+        else:
+            needing_update, missing_remote = diff_policies(debug=options["debug"], run_mode=options["mode"], workers=options["workers"])
+            outcome.update(to_update=len(needing_update), to_create=len(missing_remote))
+    except Exception as e:
+        logger.error(f"Error running {command}: {e}")
+        outcome["error"] = str(e)
+    outcome["seconds"] = time.monotonic() - started
+    outcome["api"] = METRICS.summary()
+    if options["metrics_file"]:
+        METRICS.write(org_metrics_path(options["metrics_file"], org), options["metrics_format"])
+    return outcome
+
+def run_orgs(command, orgs, args):
+    """Runs sync or diff for several orgs at once in worker processes, at most args.parallel at a time.
+
+    Each org gets its own client and its own policies/ and state/ under args.orgs_dir. Logs a combined summary
+    and returns 1 if any org failed, otherwise 0."""
+    options = {
+        "mode": args.mode,
+        "debug": args.debug,
+        "prefetch": not getattr(args, "no_prefetch", False),
+        "workers": getattr(args, "workers", None),
+        "rate": args.rate,
+        "retries": args.retries,
+        "metrics_file": os.path.abspath(args.metrics_file) if args.metrics_file else None,
+        "metrics_format": args.metrics_format,
+    }
+    outcomes = []
+    started = time.monotonic()
+    with ProcessPoolExecutor(max_workers=max(1, min(args.parallel, len(orgs)))) as executor:
+        futures = {executor.submit(run_org, command, org, api_key, os.path.abspath(os.path.join(args.orgs_dir, org)), options): org
+                   for org, api_key in orgs}
+        for future in as_completed(futures):
+            try:
+                outcome = future.result()
+            except Exception as e:
+                outcome = {"org": futures[future], "error": str(e), "seconds": 0.0, "api": None}
+            outcomes.append(outcome)
+
+    org_width = max([len("Org")] + [len(o["org"]) for o in outcomes])
+    columns = ["policies", "changed", "removed"] if command == "sync" else ["to_update", "to_create"]
+    header = "".join(f"  {column.replace('_', ' ').capitalize():>9}" for column in columns)
+    logger.info(f"{'Org':<{org_width}}{header}  {'API calls':>9}  {'Retries':>7}  {'Time':>7}  Result")
+    for o in sorted(outcomes, key=lambda o: o["org"]):
+        counts = "".join(f"  {str(o.get(column, '-')):>9}" for column in columns)
+        api = o["api"] or {"calls": 0, "retries": 0}
+        result = "ok" if o["error"] is None else f"error: {o['error']}"
+        logger.info(f"{o['org']:<{org_width}}{counts}  {api['calls']:>9}  {api['retries']:>7}  {o['seconds']:>6.2f}s  {result}")
+    failed = sum(1 for o in outcomes if o["error"] is not None)
+    logger.info(f"Ran {command} for {len(outcomes) - failed} of {len(outcomes)} orgs in {time.monotonic() - started:.1f}s, "
+                f"{failed} failed.")
+    return 1 if failed else 0
+
+def add_org_arguments(parser):
+    """Adds the options for running a command against several orgs from one process."""
+    parser.add_argument("--orgs", nargs="+", metavar="ORG[=TOKEN_ENV]",
+                        help="Run for several orgs at once. Each uses $AUTOMOX_API_KEY unless given as ORG=TOKEN_ENV_VAR")
+    parser.add_argument("--config", help="JSON file mapping org ids to API keys, or to \"$VAR\" to read a key from the environment")
+    parser.add_argument("--parallel", type=int, default=4, help="Maximum number of orgs processed at once")
+    parser.add_argument("--orgs-dir", default="orgs", help="Directory holding each org's policies/ and state/ when running for several orgs")
 
 
 def main():
     parser = argparse.ArgumentParser(description="Automox Policy Management Tool")
+    ax_client.add_arguments(parser)
     subparsers = parser.add_subparsers(dest="command", required=True)
 
     # Sync sub-command
     parser_sync = subparsers.add_parser("sync", help="Sync policies")
     parser_sync.add_argument("--mode", choices=["full", "normal"], default="normal", help="Sync mode: 'full' or 'normal'")
     parser_sync.add_argument("--debug", action="store_true", help="Enable debug logging")
+    parser_sync.add_argument("--no-prefetch", action="store_true", help="Fetch pages of policies one at a time instead of prefetching the next page")
+    ax_metrics.add_arguments(parser_sync)
+    add_org_arguments(parser_sync)
 
     # Update sub-command
     parser_update = subparsers.add_parser("update", help="Update policies")
     parser_update.add_argument("--debug", action="store_true", help="Enable debug logging")
+    parser_update.add_argument("--workers", type=int, default=4, help="Number of policies pushed concurrently")
+    ax_metrics.add_arguments(parser_update)
 
     # Diff sub-command
     parser_diff = subparsers.add_parser("diff", help="Diff policies")
     parser_diff.add_argument("--mode", choices=["flag", "normal"], default="normal", help="Diff mode: 'flag' or 'normal'")
     parser_diff.add_argument("--debug", action="store_true", help="Enable debug logging")
+    parser_diff.add_argument("--workers", type=int, default=os.cpu_count(), help="Processes used to diff changed policies")
+    ax_metrics.add_arguments(parser_diff)
+    add_org_arguments(parser_diff)
+
+    # Plan sub-command
+    parser_plan = subparsers.add_parser("plan", help="Write a JSON report of pending changes. Exits 0 if none, 2 if there are changes, 1 on errors")
+    parser_plan.add_argument("--output", default="plan.json", help="Where to write the report, '-' for stdout")
+    parser_plan.add_argument("--debug", action="store_true", help="Enable debug logging")
+    ax_metrics.add_arguments(parser_plan)
 
     args = parser.parse_args()
 
+    orgs = []
+    if getattr(args, "config", None):
+        orgs.extend(load_org_config(args.config))
+    if getattr(args, "orgs", None):
+        orgs.extend(parse_org(value) for value in args.orgs)
+    if orgs:
+        # The last key given for an org wins
+        sys.exit(run_orgs(args.command, list(dict(orgs).items()), args))
+
+    # Check if either environment variable is not set
+    if ORG is None or API_KEY is None:
+        print("Error: AUTOMOX_ORG and AUTOMOX_API_KEY environment variables must be set.")
+        sys.exit(1)  # Exit with an error status code
+    configure_org(ORG, API_KEY, rate=args.rate, max_retries=args.retries)
+
+    exit_code = 0
     if args.command == "sync":
-        sync_policies(sync_mode=args.mode, debug=args.debug)
+        sync_policies(sync_mode=args.mode, debug=args.debug, prefetch=not args.no_prefetch)
     elif args.command == "update":
-        update_policies(debug=args.debug)
+        update_policies(debug=args.debug, workers=args.workers)
     elif args.command == "diff":
-        diff_policies(run_mode=args.mode, debug=args.debug)
+        diff_policies(run_mode=args.mode, debug=args.debug, workers=args.workers)
+    elif args.command == "plan":
+        exit_code = plan_policies(output=args.output, debug=args.debug)
+
+    for line in METRICS.format_summary():
+        logger.info(line)
+    if args.metrics_file:
+        METRICS.write(args.metrics_file, args.metrics_format)
+    sys.exit(exit_code)
 
 if __name__ == '__main__':
     main()